@@ -168,6 +168,13 @@ def relecov_tools_cli(verbose, log_file):
     default=None,
     help="Flag: Select which folders will be targeted giving [paths] or via prompt",
 )
+@click.option(
+    "-i",
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Flag: Only process folders with new or changed files since last download",
+)
 def download(
     user,
     password,
@@ -175,6 +182,7 @@ def download(
     download_option,
     output_location,
     target_folders,
+    incremental,
 ):
     """Download files located in sftp server."""
     download_manager = relecov_tools.download_manager.DownloadManager(
@@ -184,6 +192,7 @@ def download(
         download_option,
         output_location,
         target_folders,
+        incremental,
     )
     download_manager.execute_process()
 
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+import paramiko
+from relecov_tools.config_json import ConfigJson
+from relecov_tools.sftp_client import SftpRelecov, TRANSPORT_ERRORS
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+log = logging.getLogger(__name__)
+# Blocks requested ahead while streaming a file. Each block is itself split by
+# asyncssh into parallel requests, so a few of them keep the pipeline full
+READ_AHEAD_BLOCKS = 4
+
+
+def translate_error(error):
+    """Convert asyncssh sftp errors into the OSError subclasses raised by paramiko,
+    e.g. FileNotFoundError, so callers handle both backends in the same way. The
+    asyncssh error is kept as __cause__ of the converted one"""
+    if asyncssh is not None and isinstance(error, asyncssh.SFTPError):
+        if error.code == asyncssh.FX_NO_SUCH_FILE:
+            translated = FileNotFoundError(2, error.reason)
+        elif error.code == asyncssh.FX_PERMISSION_DENIED:
+            translated = PermissionError(13, error.reason)
+        else:
+            translated = IOError(error.reason)
+        translated.__cause__ = error
+        return translated
+    return error
+
+
+def to_paramiko_attributes(attrs, filename=None):
+    """Convert asyncssh SFTPAttrs into paramiko SFTPAttributes"""
+    attributes = paramiko.SFTPAttributes()
+    attributes.st_size = attrs.size
+    attributes.st_mode = attrs.permissions
+    attributes.st_mtime = attrs.mtime
+    attributes.st_atime = attrs.atime
+    attributes.st_uid = attrs.uid
+    attributes.st_gid = attrs.gid
+    if filename is not None:
+        attributes.filename = filename
+    return attributes
+
+
+class AsyncSftpFile:
+    """Blocking file object over an asyncssh remote file, with the subset of
+    paramiko SFTPFile used by SftpRelecov. After prefetch(), up to max_requests
+    reads are kept in flight so the file is transferred as a pipeline.
+    """
+
+    def __init__(self, client, remote_fh, max_requests=READ_AHEAD_BLOCKS):
+        self.client = client
+        self.remote_fh = remote_fh
+        self.max_requests = max_requests
+        self.offset = 0
+        self.prefetch_end = None
+        self.read_ahead = deque()
+        self.next_offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stat(self):
+        return to_paramiko_attributes(self.client.run(self.remote_fh.stat()))
+
+    def seek(self, offset):
+        self.cancel_read_ahead()
+        self.offset = offset
+        self.next_offset = offset
+        return
+
+    def prefetch(self, file_size=None):
+        """Read the rest of the file ahead, up to file_size, as pipelined requests"""
+        if file_size is None:
+            file_size = self.stat().st_size
+        self.prefetch_end = file_size
+        self.next_offset = self.offset
+        return
+
+    def read(self, size):
+        if self.prefetch_end is None:
+            data = self.client.run(self.remote_fh.read(size, self.offset))
+            self.offset += len(data)
+            return data
+        while (
+            len(self.read_ahead) < self.max_requests
+            and self.next_offset < self.prefetch_end
+        ):
+            future = self.client.submit(self.remote_fh.read(size, self.next_offset))
+            self.read_ahead.append((self.next_offset, size, future))
+            self.next_offset += size
+        if not self.read_ahead:
+            return self.client.run(self.remote_fh.read(size, self.offset))
+        offset, requested, future = self.read_ahead.popleft()
+        try:
+            data = future.result()
+        except Exception as e:
+            self.cancel_read_ahead()
+            raise translate_error(e)
+        self.offset = offset + len(data)
+        if len(data) < requested and self.offset < self.prefetch_end:
+            # Short read: discard the requests ahead and continue from here
+            self.cancel_read_ahead()
+            self.next_offset = self.offset
+        return data
+
+    def readv(self, chunks):
+        """Read each (offset, size) chunk, split by asyncssh in parallel requests"""
+        for offset, size in chunks:
+            yield self.client.run(self.remote_fh.read(size, offset))
+
+    def cancel_read_ahead(self):
+        while self.read_ahead:
+            self.read_ahead.popleft()[2].cancel()
+        return
+
+    def close(self):
+        self.cancel_read_ahead()
+        try:
+            self.client.run(self.remote_fh.close())
+        except (OSError, asyncssh.Error) as e:
+            log.debug("Could not close remote file: %s", e)
+        return
+
+
+class AsyncSftpClient:
+    """Blocking interface with the subset of paramiko SFTPClient methods used by
+    SftpRelecov, running every request in the event loop of AsyncSftpRelecov.
+    Requests from different threads are sent concurrently over one connection.
+    """
+
+    def __init__(self, owner, sftp_client):
+        self.owner = owner
+        self.sftp_client = sftp_client
+        self.closed = False
+
+    def run(self, coroutine):
+        return self.owner.run(coroutine)
+
+    def submit(self, coroutine):
+        return self.owner.submit(coroutine)
+
+    def listdir_attr(self, path="."):
+        names = self.run(self.sftp_client.readdir(path))
+        return [
+            to_paramiko_attributes(name.attrs, name.filename)
+            for name in names
+            if name.filename not in (".", "..")
+        ]
+
+    def stat(self, path):
+        return to_paramiko_attributes(self.run(self.sftp_client.stat(path)))
+
+    def open(self, path, mode="r"):
+        remote_fh = self.run(self.sftp_client.open(path, mode, encoding=None))
+        return AsyncSftpFile(self, remote_fh)
+
+    def rename(self, old_path, new_path):
+        return self.run(self.sftp_client.rename(old_path, new_path))
+
+    def remove(self, path):
+        return self.run(self.sftp_client.remove(path))
+
+    def rmdir(self, path):
+        return self.run(self.sftp_client.rmdir(path))
+
+    def mkdir(self, path):
+        return self.run(self.sftp_client.mkdir(path))
+
+    def put(self, local_path, remote_path):
+        return self.run(self.sftp_client.put(local_path, remote_path))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.sftp_client.exit()
+        return
+
+
+class AsyncSftpRelecov(SftpRelecov):
+    """SftpRelecov backend built on asyncssh. An event loop running in a
+    background thread owns a single ssh connection, and every sftp request is
+    sent through it. Calls from several threads, or batches sent with
+    run_concurrently(), are pipelined over that connection instead of waiting
+    for each round trip. new_session() returns this same client, so the session
+    pool shares the connection too.
+
+    Select it with "sftp_backend": "asyncssh" in sftp_handle configuration.
+    """
+
+    multiplexed = True
+
+    def __init__(self, conf_file=None, username=None, password=None):
+        if asyncssh is None:
+            raise ModuleNotFoundError("asyncssh is required for the asyncssh backend")
+        super().__init__(conf_file, username, password)
+        self.max_requests = int(
+            ConfigJson().get_topic_data("sftp_handle", "max_concurrent_requests") or 64
+        )
+        self.loop = None
+        self.loop_thread = None
+        self.connection = None
+        self.sftp = None
+        self.connect_lock = threading.Lock()
+
+    def start_loop(self):
+        """Start the event loop in a daemon thread if it is not running yet"""
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(
+            target=self.loop.run_forever, name="async-sftp", daemon=True
+        )
+        self.loop_thread.start()
+        return
+
+    def submit(self, awaitable):
+        """Schedule an awaitable in the event loop, returning a future"""
+
+        async def wait_for(awaitable):
+            return await awaitable
+
+        return asyncio.run_coroutine_threadsafe(wait_for(awaitable), self.loop)
+
+    def run(self, awaitable):
+        """Run an awaitable in the event loop and wait for its result"""
+        try:
+            return self.submit(awaitable).result()
+        except Exception as e:
+            raise translate_error(e)
+
+    def new_session(self):
+        """All sessions share the same multiplexed connection"""
+        return self
+
+    def open_connection(self):
+        """Establishing sftp connection"""
+        with self.connect_lock:
+            if self.is_alive():
+                return True
+            self.start_loop()
+            log.info("Setting credentials for async SFTP connection")
+            start = time.perf_counter()
+            self.connection = self.run(
+                asyncssh.connect(
+                    self.sftp_server,
+                    port=int(self.sftp_port),
+                    username=self.user_name,
+                    password=self.password,
+                    known_hosts=None,
+                    client_keys=None,
+                    agent_path=None,
+                    keepalive_interval=self.keepalive_interval,
+                )
+            )
+            try:
+                log.info("Trying to establish async SFTP connection")
+                sftp_client = self.run(self.connection.start_sftp_client())
+            except (OSError, asyncssh.Error) as e:
+                log.error("Could not establish SFTP connection: %s", e)
+                return False
+            self.sftp = AsyncSftpClient(self, sftp_client)
+            self.connection_stats["connections"] += 1
+            self.connection_stats["connect_seconds"] += time.perf_counter() - start
+        return True
+
+    def is_alive(self):
+        """Health check: True if the ssh connection and the sftp session are open"""
+        if self.connection is None or self.sftp is None or self.sftp.closed:
+            return False
+        return not self.connection.is_closed()
+
+    def is_transport_error(self, error):
+        # Errors raised by run() are translated, classify the asyncssh one
+        if isinstance(error.__cause__, asyncssh.Error):
+            error = error.__cause__
+        if isinstance(error, (asyncssh.PermissionDenied, asyncssh.SFTPError)):
+            return isinstance(
+                error, (asyncssh.SFTPConnectionLost, asyncssh.SFTPNoConnection)
+            )
+        if isinstance(error, (asyncssh.DisconnectError, asyncssh.ConnectionLost)):
+            return True
+        return super().is_transport_error(error)
+
+    def reconnect(self):
+        """Close the current connection and open a new one. Several threads may
+        detect the same failure, so only the first one reconnects."""
+        with self.connect_lock:
+            if self.is_alive():
+                return True
+            self.connection_stats["reconnections"] += 1
+            self.close_transport()
+        try:
+            if self.open_connection():
+                return True
+        except (*TRANSPORT_ERRORS, OSError, asyncssh.Error) as e:
+            log.warning("Could not reconnect to %s: %s", self.sftp_server, e)
+        self.connection_stats["failed_reconnections"] += 1
+        return False
+
+    def close_transport(self):
+        """Close the ssh connection, not only the sftp session"""
+        if self.connection is not None:
+            self.connection.close()
+            try:
+                self.run(self.connection.wait_closed())
+            except (OSError, asyncssh.Error):
+                pass
+        self.connection = None
+        self.sftp = None
+        return
+
+    def close_connection(self):
+        log.info("Closing SFTP connection")
+        if self.sftp is None:
+            log.warning("Could not close sftp connection")
+            return False
+        self.sftp.close()
+        log.info("SFTP connection closed")
+        return True
+
+    def run_concurrently(self, operation, arguments, max_requests=None):
+        """Send many sftp requests of the same kind at the same time over the
+        connection, with at most max_requests of them waiting for a reply.
+
+        Args:
+            operation (str): asyncssh SFTPClient method, e.g. "rename", "remove"
+            arguments (list(tuple)): arguments for each request
+            max_requests (int, optional): Defaults to max_concurrent_requests
+
+        Returns:
+            results (list): result of each request in the same order as the
+            arguments. Failed requests return their exception instead.
+        """
+        if not self.is_alive():
+            self.reconnect()
+        max_requests = max_requests or self.max_requests
+        method = getattr(self.sftp.sftp_client, operation)
+
+        async def limited_request(limit, args):
+            async with limit:
+                return await method(*args)
+
+        async def send_all():
+            # Created here so it is bound to the loop that runs the requests
+            limit = asyncio.Semaphore(max_requests)
+            return await asyncio.gather(
+                *[limited_request(limit, args) for args in arguments],
+                return_exceptions=True,
+            )
+
+        results = self.run(send_all())
+        return [
+            translate_error(res) if isinstance(res, Exception) else res
+            for res in results
+        ]
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import threading
+import jsonschema
+from jsonschema import Draft202012Validator
+from relecov_tools.config_json import ConfigJson
+
+log = logging.getLogger(__name__)
+# Increase it when the compiled tables change, so older artefacts are rebuilt
+COMPILED_SCHEMA_VERSION = 2
+
+
+class CompiledSchema:
+    """A json schema together with the lookup tables that the schema-driven
+    modules derive from it. The tables are built once per schema content and can
+    be stored as a pickle artefact, so later runs load them at once instead of
+    walking the schema again. They are shared by every module, so they must not
+    be modified.
+
+    Attributes:
+        schema (dict): the json schema itself
+        schema_md5 (str): md5 of the schema file content
+        label_to_property (dict): {label: property}
+        property_to_label (dict): {property: label}
+        unlabeled_properties (list): properties without a label
+        ontology_to_property (dict): {ontology: property}, including "0" and ""
+        enum_values (dict): {property: {enum value without ontology: enum value}}
+        required (list): required properties
+        draft_error (str): reason why the schema does not fulfill Draft 2020-12,
+        None if it is valid
+    """
+
+    def __init__(self, schema, schema_md5=None):
+        self.schema = schema
+        self.schema_md5 = schema_md5
+        self.version = COMPILED_SCHEMA_VERSION
+        self.label_to_property = {}
+        self.property_to_label = {}
+        self.unlabeled_properties = []
+        self.ontology_to_property = {}
+        self.enum_values = {}
+        ontology_pattern = re.compile(r"(.+) \[\w+:.*")
+        for prop, values in schema.get("properties", {}).items():
+            if "label" in values:
+                self.label_to_property[values["label"]] = prop
+                self.property_to_label[prop] = values["label"]
+            else:
+                self.unlabeled_properties.append(prop)
+            if "ontology" in values:
+                self.ontology_to_property[values["ontology"]] = prop
+            if "enum" in values:
+                self.enum_values[prop] = {}
+                for enum in values["enum"]:
+                    go_match = ontology_pattern.search(enum)
+                    if go_match:
+                        self.enum_values[prop][go_match.group(1)] = enum
+                    else:
+                        self.enum_values[prop][enum] = enum
+        self.required = list(schema.get("required", []))
+        try:
+            Draft202012Validator.check_schema(schema)
+            self.draft_error = None
+        except jsonschema.SchemaError as e:
+            self.draft_error = e.message
+
+    @staticmethod
+    def get_artefact_name(schema_file, schema_md5):
+        """Return the file name of the artefact for a schema content"""
+        schema_name = os.path.splitext(os.path.basename(schema_file))[0]
+        return "%s.%s.v%s.pickle" % (schema_name, schema_md5, COMPILED_SCHEMA_VERSION)
+
+    @classmethod
+    def load(cls, schema_file, cache_folder=None):
+        """Return the compiled schema for a json schema file, loading it from its
+        artefact in cache_folder if it was already built for the same content.
+        Otherwise it is built and the artefact written for next runs.
+
+        Args:
+            schema_file (str): path to the json schema
+            cache_folder (str, optional): folder with the compiled artefacts
+
+        Returns:
+            compiled_schema (CompiledSchema): schema and its lookup tables
+        """
+        with open(schema_file, "rb") as fh:
+            content = fh.read()
+        schema_md5 = hashlib.md5(content).hexdigest()
+        artefact_path = None
+        if cache_folder:
+            artefact_path = os.path.join(
+                cache_folder, cls.get_artefact_name(schema_file, schema_md5)
+            )
+            try:
+                with open(artefact_path, "rb") as fh:
+                    compiled = pickle.load(fh)
+                if (
+                    isinstance(compiled, cls)
+                    and compiled.version == COMPILED_SCHEMA_VERSION
+                    and compiled.schema_md5 == schema_md5
+                ):
+                    return compiled
+                log.warning("Outdated compiled schema %s. Rebuilding", artefact_path)
+            except FileNotFoundError:
+                pass
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+                log.warning("Invalid compiled schema %s: %s", artefact_path, e)
+        compiled = cls(json.loads(content), schema_md5)
+        if artefact_path:
+            compiled.save(artefact_path)
+        return compiled
+
+    def save(self, artefact_path):
+        """Write the compiled schema to artefact_path, replacing it atomically"""
+        tmp_path = artefact_path + ".%s.tmp" % os.getpid()
+        try:
+            os.makedirs(os.path.dirname(artefact_path), exist_ok=True)
+            with open(tmp_path, "wb") as fh:
+                pickle.dump(self, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, artefact_path)
+        except OSError as e:
+            log.warning("Could not save compiled schema to %s: %s", artefact_path, e)
+        return
+
+
+_compiled_schemas = {}
+_compiled_schemas_lock = threading.Lock()
+
+
+def get_cache_folder():
+    """Return the folder for compiled schema artefacts following compiled_schema
+    in configuration.json, or the user cache folder if it is not set. None if
+    the artefacts are disabled"""
+    cache_config = ConfigJson().get_configuration("compiled_schema") or {}
+    if str(cache_config.get("enabled", "True")) != "True":
+        return None
+    if cache_config.get("cache_folder"):
+        return os.path.expanduser(cache_config["cache_folder"])
+    user_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(user_cache, "relecov_tools", "compiled_schemas")
+
+
+def load_schema(schema_file):
+    """Return the compiled schema for a json schema file. It is only loaded once
+    per process for each file path and content, using the default cache folder"""
+    real_path = os.path.realpath(schema_file)
+    mtime_ns = os.stat(real_path).st_mtime_ns
+    with _compiled_schemas_lock:
+        compiled = _compiled_schemas.get(real_path)
+        if compiled is not None and compiled[0] == mtime_ns:
+            return compiled[1]
+    compiled_schema = CompiledSchema.load(real_path, get_cache_folder())
+    with _compiled_schemas_lock:
+        _compiled_schemas[real_path] = (mtime_ns, compiled_schema)
+    return compiled_schema
@@ -1,27 +1,79 @@
 #!/usr/bin/env python
 import json
 import os
+import threading
+
+CONF_FOLDER = os.path.join(os.path.dirname(__file__), "conf")
+
+_loaded_files = {}
+_loaded_files_lock = threading.Lock()
+
+
+def load_json_file(json_file):
+    """Return the parsed content of a json file together with an index of the
+    items nested in each topic. The file is only parsed once per process while
+    it is not modified, and the same objects are returned to every caller, so
+    they must not be modified.
+
+    Args:
+        json_file (str): path to the json file
+
+    Returns:
+        json_data (dict): content of the json file
+        topic_index (dict): {topic: {item: value}} with the items of each topic
+        and the ones of its nested dicts, as found by get_topic_data()
+    """
+    real_path = os.path.realpath(json_file)
+    mtime_ns = os.stat(real_path).st_mtime_ns
+    with _loaded_files_lock:
+        loaded = _loaded_files.get(real_path)
+    if loaded is not None and loaded[0] == mtime_ns:
+        return loaded[1], loaded[2]
+    with open(real_path) as fh:
+        json_data = json.load(fh)
+    topic_index = {}
+    if isinstance(json_data, dict):
+        for topic, topic_data in json_data.items():
+            if not isinstance(topic_data, dict):
+                continue
+            index = {}
+            # Items in the topic itself take precedence over the nested ones
+            for value in topic_data.values():
+                if isinstance(value, dict):
+                    for item, item_value in value.items():
+                        index.setdefault(item, item_value)
+            index.update(topic_data)
+            topic_index[topic] = index
+    with _loaded_files_lock:
+        _loaded_files[real_path] = (mtime_ns, json_data, topic_index)
+    return json_data, topic_index
+
+
+def get_conf_json(file_name):
+    """Return the content of an auxiliary json file in the conf folder, e.g.
+    laboratory_address.json. It is only read the first time it is needed"""
+    return load_json_file(os.path.join(CONF_FOLDER, file_name))[0]
 
 
 # pass test
 class ConfigJson:
     def __init__(
         self,
-        json_file=os.path.join(os.path.dirname(__file__), "conf", "configuration.json"),
+        json_file=os.path.join(CONF_FOLDER, "configuration.json"),
     ):
-        fh = open(json_file)
-        self.json_data = json.load(fh)
-        fh.close()
+        self.json_data, self.topic_index = load_json_file(json_file)
         self.topic_config = list(self.json_data.keys())
 
     def get_configuration(self, topic):
         """Obtain the topic configuration from json data"""
-        if topic in self.topic_config:
+        if topic in self.json_data:
             return self.json_data[topic]
         return None
 
     def get_topic_data(self, topic, found):
         """Obtain from topic any forward items from json data"""
+        if topic in self.topic_index:
+            return self.topic_index[topic].get(found)
         if found in self.json_data[topic]:
             return self.json_data[topic][found]
         else:
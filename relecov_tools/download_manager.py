@@ -4,17 +4,22 @@ import logging
 import json
 import sys
 import os
+import shutil
+import threading
 import yaml
 import warnings
 import rich.console
 import paramiko
 import relecov_tools.utils
+import relecov_tools.hash_cache
 import relecov_tools.sftp_client
+import relecov_tools.sync_manifest
+import relecov_tools.transfer_metrics
+import relecov_tools.workbook_cache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from itertools import islice
 from secrets import token_hex
 from csv import writer as csv_writer, Error as CsvError
-from openpyxl import load_workbook as openpyxl_load_workbook
 from pandas import read_excel, ExcelWriter, concat
 from pandas.errors import ParserError, EmptyDataError
 from relecov_tools.config_json import ConfigJson
@@ -37,7 +42,28 @@ class MetadataError(Exception):
         super().__init__(message)
 
 
+def task_local_property(name):
+    """Attribute of DownloadManager that a task processing a folder in parallel
+    can override for its own thread, without affecting the other tasks"""
+    private_name = "_" + name
+
+    def getter(self):
+        return getattr(self.task_context, name, getattr(self, private_name, None))
+
+    def setter(self, value):
+        if getattr(self.task_context, "active", False):
+            setattr(self.task_context, name, value)
+        else:
+            setattr(self, private_name, value)
+
+    return property(getter, setter)
+
+
 class DownloadManager:
+    current_folder = task_local_property("current_folder")
+    relecov_sftp = task_local_property("relecov_sftp")
+    logsum = task_local_property("logsum")
+
     def __init__(
         self,
         user=None,
@@ -46,8 +72,11 @@ class DownloadManager:
         download_option=None,
         output_location=None,
         target_folders=None,
+        incremental=False,
     ):
         """Initializes the sftp object"""
+        # Per thread state of the tasks processing folders in parallel
+        self.task_context = threading.local()
         config_json = ConfigJson()
         self.allowed_file_ext = config_json.get_topic_data(
             "sftp_handle", "allowed_file_extensions"
@@ -55,6 +84,7 @@ class DownloadManager:
         sftp_user = user
         sftp_passwd = passwd
         self.target_folders = target_folders
+        self.incremental = incremental
         self.allowed_download_options = config_json.get_topic_data(
             "sftp_handle", "allowed_download_options"
         )
@@ -113,6 +143,8 @@ class DownloadManager:
         if isinstance(self.target_folders, str):
             self.target_folders = self.target_folders.split(",")
         self.logsum = LogSum(output_location=self.platform_storage_folder)
+        # Keep md5 hashes of downloaded files between runs, opened when first used
+        relecov_tools.hash_cache.set_default_cache(self.platform_storage_folder)
         if sftp_passwd is None:
             sftp_passwd = relecov_tools.utils.prompt_password(msg="Enter your password")
         self.metadata_lab_heading = config_json.get_topic_data(
@@ -127,10 +159,52 @@ class DownloadManager:
         self.samples_json_fields = config_json.get_topic_data(
             "lab_metadata", "samples_json_fields"
         )
+        self.parallel_downloads = int(
+            config_json.get_topic_data("sftp_handle", "parallel_downloads") or 1
+        )
+        self.parallel_folders = int(
+            config_json.get_topic_data("sftp_handle", "parallel_folders") or 1
+        )
+        self.download_planning = (
+            config_json.get_topic_data("sftp_handle", "download_planning") or {}
+        )
+        self.metrics_config = (
+            config_json.get_topic_data("sftp_handle", "transfer_metrics") or {}
+        )
+        self.compression = (
+            config_json.get_topic_data("sftp_handle", "compression") or {}
+        )
+        self.download_retries = int(
+            config_json.get_topic_data("sftp_handle", "download_retries") or 3
+        )
+        self.compression_workers = int(
+            self.compression.get("workers") or os.cpu_count() or 1
+        )
+        # Pool of compression processes shared by every folder during download
+        self.compression_pool = None
         # initialize the sftp client
-        self.relecov_sftp = relecov_tools.sftp_client.SftpRelecov(
+        self.relecov_sftp = relecov_tools.sftp_client.create_sftp_client(
             conf_file, sftp_user, sftp_passwd
         )
+        # Independent sessions used to download several files at the same time
+        self.sftp_pool = relecov_tools.sftp_client.SftpSessionPool(
+            self.relecov_sftp, size=self.parallel_downloads
+        )
+        # One session for each of the folders processed at the same time
+        self.folder_sessions = relecov_tools.sftp_client.SftpSessionPool(
+            self.relecov_sftp, size=self.parallel_folders
+        )
+        # Remote folders are listed once and then queried from this snapshot
+        self.remote_tree = relecov_tools.sftp_client.RemoteTreeSnapshot(
+            self.relecov_sftp
+        )
+        # Record of the files fetched in previous runs, used in incremental mode
+        manifest_filename = config_json.get_topic_data(
+            "sftp_handle", "sync_manifest_filename"
+        )
+        self.sync_manifest = relecov_tools.sync_manifest.SyncManifest(
+            os.path.join(self.platform_storage_folder, manifest_filename)
+        )
         self.finished_folders = {}
 
     def create_local_folder(self, folder):
@@ -155,7 +229,9 @@ class DownloadManager:
 
     def get_remote_folder_files(self, folder, local_folder, file_list):
         """Create the subfolder with the present date and fetch all files from
-        the remote sftp server
+        the remote sftp server. Files are scheduled largest-first and downloaded
+        concurrently using as many sftp sessions as defined by parallel_downloads.
+        The md5 hash of each file is computed while it is being downloaded.
 
         Args:
             folder (str): name of remote folder to be downloaded
@@ -163,29 +239,204 @@ class DownloadManager:
             file_list (list(str)): list of files in remote folder to be downloaded
 
         Returns:
-            fetched_files(list(str)): list of successfully downloaded files
+            fetched_files(dict(str:dict)): successfully downloaded files and their
+            stream info: {file: {"md5": hash, "gzip_integrity": bool, "size": int}}
         """
 
-        fetched_files = list()
-        log.info("Trying to fetch files in remote server")
-        stderr.print(f"Fetching {len(file_list)} files from {folder}")
-        for file in file_list:
+        def stream_file(sftp_session, file_to_fetch, output_file, exist_ok=False):
+            """Download a file once. Failed downloads, e.g. incomplete ones, are
+            logged and return False so they can be retried"""
+            try:
+                return sftp_session.stream_from_sftp(
+                    file_to_fetch, output_file, exist_ok=exist_ok
+                )
+            except (OSError, paramiko.SSHException) as e:
+                log.error("Could not fetch %s: %s" % (file_to_fetch, e))
+                return False
+
+        def fetch_file(sftp_session, file):
+            """Download a single file, retrying n times if download fails"""
             file_to_fetch = os.path.join(folder, os.path.basename(file))
             output_file = os.path.join(local_folder, os.path.basename(file))
-            if self.relecov_sftp.get_from_sftp(
-                file_to_fetch, output_file, exist_ok=True
-            ):
-                fetched_files.append(os.path.basename(file))
-            else:
-                # Try to download again n times
-                for _ in range(3):
-                    if self.relecov_sftp.get_from_sftp(file_to_fetch, output_file):
-                        fetched_files.append(os.path.basename(file))
-                        break
-                else:
-                    log.warning("Couldn't fetch %s from %s after 3 tries", file, folder)
+            if self.incremental:
+                synced_info = self.reuse_synced_file(file_to_fetch, output_file)
+                if synced_info:
+                    return synced_info
+            stream_info = stream_file(
+                sftp_session, file_to_fetch, output_file, exist_ok=True
+            )
+            if stream_info:
+                return stream_info
+            # Try to download again n times
+            metrics = relecov_tools.transfer_metrics.get_default_metrics()
+            for _ in range(self.download_retries):
+                metrics.record("download", output_file, retries=1)
+                stream_info = stream_file(sftp_session, file_to_fetch, output_file)
+                if stream_info:
+                    return stream_info
+            log_text = "Couldn't fetch %s from %s after %s tries"
+            log.warning(log_text % (file, folder, self.download_retries))
+            return False
+
+        def pooled_fetch(file):
+            try:
+                with self.sftp_pool.session() as sftp_session:
+                    return fetch_file(sftp_session, file)
+            except (OSError, paramiko.SSHException) as e:
+                # e.g. no session could be opened for this file
+                log.error("Could not fetch %s from %s: %s" % (file, folder, e))
+                return False
+
+        log.info("Trying to fetch files in remote server")
+        stderr.print(f"Fetching {len(file_list)} files from {folder}")
+        if self.sftp_pool.size <= 1 or len(file_list) <= 1:
+            fetched_status = {
+                file: fetch_file(self.relecov_sftp, file) for file in file_list
+            }
+        else:
+            try:
+                remote_sizes = self.remote_tree.get_file_sizes(folder)
+            except (FileNotFoundError, OSError) as e:
+                log.warning("Could not get file sizes in %s: %s" % (folder, e))
+                remote_sizes = {}
+            # Largest files first so the pool is not left waiting for a big one
+            schedule = sorted(
+                file_list,
+                key=lambda fi: remote_sizes.get(os.path.basename(fi), 0),
+                reverse=True,
+            )
+            with ThreadPoolExecutor(max_workers=self.sftp_pool.size) as executor:
+                fetched_status = dict(
+                    zip(schedule, executor.map(pooled_fetch, schedule))
+                )
+        fetched_files = {
+            os.path.basename(file): fetched_status[file]
+            for file in file_list
+            if fetched_status.get(file)
+        }
         return fetched_files
 
+    def reuse_synced_file(self, remote_file, output_file):
+        """Reuse the local copy of a remote file fetched in a previous run if the
+        remote file did not change since then, linking it into the new location
+
+        Args:
+            remote_file (str): path to the file in remote sftp
+            output_file (str): path where the file should be downloaded
+
+        Returns:
+            stream info (dict): {"md5": hash, "gzip_integrity": None, "size": int}
+            False if the file is new, changed or its local copy is not valid
+        """
+        remote_attrs = self.remote_tree.get_file_attributes(
+            os.path.dirname(remote_file)
+        )
+        attr = remote_attrs.get(os.path.basename(remote_file))
+        if attr is None:
+            return False
+        if not self.sync_manifest.is_unchanged(
+            remote_file, attr.st_size, attr.st_mtime
+        ):
+            return False
+        synced_entry = self.sync_manifest.get(remote_file)
+        synced_path = synced_entry.get("local_path")
+        if not synced_path or not os.path.isfile(synced_path):
+            return False
+        if os.path.getsize(synced_path) != attr.st_size:
+            return False
+        try:
+            if os.path.realpath(synced_path) != os.path.realpath(output_file):
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                try:
+                    os.link(synced_path, output_file)
+                except OSError:
+                    shutil.copy2(synced_path, output_file)
+            local_md5 = relecov_tools.utils.calculate_md5(output_file)
+        except OSError as e:
+            log.warning("Could not reuse %s for %s: %s" % (synced_path, remote_file, e))
+            return False
+        if local_md5 != synced_entry.get("md5"):
+            log.warning("Local copy %s was modified, fetching again" % synced_path)
+            os.remove(output_file)
+            return False
+        log.info("%s did not change since last sync. Reused local copy" % remote_file)
+        return {"md5": local_md5, "gzip_integrity": None, "size": attr.st_size}
+
+    def record_synced_files(self, folder, local_folder, file_hashes):
+        """Include the fetched files in the sync manifest and save it
+
+        Args:
+            folder (str): path to the folder in remote repository
+            local_folder (str): path to the local folder where files were fetched
+            file_hashes (dict(str:str)): {file basename: md5} of the fetched files
+        """
+        remote_attrs = self.remote_tree.get_file_attributes(folder)
+        for file, md5 in file_hashes.items():
+            attr = remote_attrs.get(file)
+            if attr is None or md5 is None:
+                continue
+            self.sync_manifest.record(
+                os.path.join(folder, file),
+                attr.st_size,
+                attr.st_mtime,
+                md5,
+                local_path=os.path.join(local_folder, file),
+            )
+        # Only size and mtime of metadata and md5sum files are needed to detect
+        # changes in the folder, their local copies are not reused
+        for file in self.get_control_files(remote_attrs):
+            attr = remote_attrs[file]
+            self.sync_manifest.record(
+                os.path.join(folder, file), attr.st_size, attr.st_mtime, None
+            )
+        self.sync_manifest.save()
+        return
+
+    def get_control_files(self, files):
+        """Return the metadata excel and md5sum files from a list of files"""
+        return [
+            fi
+            for fi in files
+            if fi.endswith(".xlsx") or "md5sum" in os.path.basename(fi)
+        ]
+
+    def filter_unchanged_folders(self, folders_to_process):
+        """Skip the folders whose sequencing, metadata and md5sum files were all
+        fetched in previous runs and did not change since then, according to the
+        sync manifest. Folders without any of those files are never skipped
+
+        Args:
+            folders_to_process (dict(str:list)): Dictionary with folders and files
+
+        Returns:
+            changed_folders (dict(str:list)): Same dict without unchanged folders
+        """
+        changed_folders = {}
+        for folder, files in folders_to_process.items():
+            remote_attrs = self.remote_tree.get_file_attributes(folder)
+            synced_files = [
+                fi for fi in files if fi.endswith(tuple(self.allowed_file_ext))
+            ] + self.get_control_files(files)
+            if not synced_files:
+                log.info("No files to compare with sync manifest in %s", folder)
+                changed_folders[folder] = files
+                continue
+            for file in synced_files:
+                attr = remote_attrs.get(os.path.basename(file))
+                if attr is None or not self.sync_manifest.is_unchanged(
+                    file, attr.st_size, attr.st_mtime
+                ):
+                    changed_folders[folder] = files
+                    break
+            else:
+                log.info("No new or changed files in %s since last sync", folder)
+        log.info(
+            "Incremental mode: %s of %s folders with new or changed files"
+            % (len(changed_folders), len(folders_to_process))
+        )
+        return changed_folders
+
     def find_remote_md5sum(self, folder, pattern="md5sum"):
         """Search for a pattern in remote folder, by default is md5sum
 
@@ -196,15 +447,31 @@ class DownloadManager:
         Returns:
             md5_file(str): file basename if found. If not found returns False
         """
-        all_files = self.relecov_sftp.get_file_list(folder)
+        all_files = self.remote_tree.get_file_list(folder)
         md5_file = [file for file in all_files if pattern in file]
         if len(md5_file) == 1:
             return md5_file[0]
         else:
             return False
 
-    def verify_md5_checksum(self, local_folder, fetched_files, fetched_md5):
-        """Check if the md5 value from sftp matches with the one generated locally"""
+    def verify_md5_checksum(
+        self, local_folder, fetched_files, fetched_md5, local_hashes=None
+    ):
+        """Check if the md5 value from sftp matches with the one generated locally
+
+        Args:
+            local_folder (str): Path to folder with downloaded files
+            fetched_files (list(str)): Names of the downloaded files
+            fetched_md5 (str): Path to the downloaded md5sum file
+            local_hashes (dict(str:str), optional): {file: md5} already computed
+            during download. Files not included here are hashed from disk.
+
+        Returns:
+            successful_files (list(str)): Files matching the md5sum hash
+            required_retransmition (list(str)): Files with md5 mismatch
+        """
+        if local_hashes is None:
+            local_hashes = {}
         required_retransmition = []
         successful_files = []
         # fetch the md5 file if exists
@@ -215,14 +482,17 @@ class DownloadManager:
         if not hash_dict:
             error_text = "md5sum file could not be read, md5 hashes won't be validated"
             self.include_warning(error_text)
-            return fetched_files, False
+            return list(fetched_files), False
         # check md5 checksum for each file
         for f_name in hash_dict.keys():
             if f_name not in fetched_files:
                 # Skip those files in md5sum that were not downloaded by any reason
                 continue
             f_path = os.path.join(local_folder, f_name)
-            if hash_dict[f_name] == relecov_tools.utils.calculate_md5(f_path):
+            local_md5 = local_hashes.get(f_name)
+            if local_md5 is None:
+                local_md5 = relecov_tools.utils.calculate_md5(f_path)
+            if hash_dict[f_name] == local_md5:
                 successful_files.append(f_name)
                 log.info("Successful file download for %s", f_name)
             else:
@@ -285,15 +555,14 @@ class DownloadManager:
         """
         inverted_dict = {}
         for sample, fastq_dict in sample_file_dict.items():
-            # Dictionary values are not hashable, so you need to create a tuple of them
-            samp_fastqs = tuple(fastq_dict.values())
             # Setting values as keys to find those samples refering to the same file
-            for fastq in samp_fastqs:
-                inverted_dict[fastq] = inverted_dict.get(fastq, []) + [sample]
+            for fastq in fastq_dict.values():
+                inverted_dict.setdefault(fastq, []).append(sample)
         duplicated_dict = {k: v for k, v in inverted_dict.items() if len(v) > 1}
         dup_samples_list = [samp for dups in duplicated_dict.values() for samp in dups]
+        dup_samples_set = set(dup_samples_list)
         non_duplicated_keys = {
-            k: v for k, v in sample_file_dict.items() if k not in dup_samples_list
+            k: v for k, v in sample_file_dict.items() if k not in dup_samples_set
         }
         clean_sample_dict = {key: sample_file_dict[key] for key in non_duplicated_keys}
         if dup_samples_list:
@@ -316,25 +585,27 @@ class DownloadManager:
             MetadataError: If the header in the excel is different from config
 
         Returns:
-            ws_metadata_lab: openpyxl's workbook metadata sheet of the excel file
+            ws_metadata_lab: ParsedSheet with the rows after the header
             metadata_header: column names of the header
             header_row: row where the header is located in the sheet
         """
         warnings.simplefilter(action="ignore", category=UserWarning)
-        wb_file = openpyxl_load_workbook(meta_f_path, data_only=True)
-        ws_metadata_lab = wb_file[self.metadata_processing.get("excel_sheet")]
         # find out the index for file names
         header_flag = self.metadata_processing.get("header_flag")
         try:
-            header_row = [
-                i + 1 for i, x in enumerate(ws_metadata_lab.values) if header_flag in x
-            ][0]
-        except IndexError:
+            ws_metadata_lab = relecov_tools.utils.read_excel_sheet(
+                meta_f_path,
+                self.metadata_processing.get("excel_sheet"),
+                header_flag,
+                max_empty_rows=self.metadata_processing.get("max_empty_rows"),
+            )
+        except KeyError as e:
+            if header_flag not in str(e):
+                raise
             error_text = "Header could not be found for excel file %s"
             raise MetadataError(str(error_text % os.path.basename(meta_f_path)))
-        for cell in ws_metadata_lab[header_row]:
-            cell.value = cell.value.strip()
-        metadata_header = [x.value for x in ws_metadata_lab[header_row]]
+        header_row = ws_metadata_lab.header_row
+        metadata_header = [x.strip() for x in ws_metadata_lab.header]
         meta_column_list = self.metadata_lab_heading
         if meta_column_list != metadata_header[1:]:
             diffs = [
@@ -379,9 +650,7 @@ class DownloadManager:
         index_layout = meta_header.index("Library Layout")
         index_fastq_r1 = meta_header.index("Sequence file R1 fastq")
         index_fastq_r2 = meta_header.index("Sequence file R2 fastq")
-        counter = header_row
-        for row in islice(metadata_ws.values, header_row, metadata_ws.max_row):
-            counter += 1
+        for counter, row in metadata_ws.iter_rows():
             if row[index_sampleID] is not None:
                 row_complete = True
                 try:
@@ -437,7 +706,7 @@ class DownloadManager:
         Returns:
             local_meta_file: Path to downloaded metadata file / merged metadata file.
         """
-        remote_files_list = self.relecov_sftp.get_file_list(remote_folder)
+        remote_files_list = self.remote_tree.get_file_list(remote_folder)
         meta_files = [fi for fi in remote_files_list if fi.endswith(".xlsx")]
 
         def download_remote_metafile(target_meta_file):
@@ -476,21 +745,13 @@ class DownloadManager:
                     error_text = f"Could not process {os.path.basename(loc_meta)}: {e}"
                     self.include_error(error_text)
                 os.remove(loc_meta)
-            if meta_df_list:
-                merged_df = meta_df_list[0]
-            else:
+            if not meta_df_list:
                 raise MetadataError("No single metadata file could be merged")
-            for meta_df in meta_df_list[1:]:
-                merged_df = self.merge_metadata(metadata_ws, merged_df, meta_df)
+            merged_df = self.merge_metadata(metadata_ws, *meta_df_list)
             folder_name = os.path.dirname(local_meta_file)
             excel_name = str(folder_name.split("/")[-1]) + "merged_metadata.xlsx"
             merged_excel_path = os.path.join(folder_name, excel_name)
-            pd_writer = ExcelWriter(merged_excel_path, engine="xlsxwriter")
-            for sheet in merged_df.keys():
-                format_sheet = merged_df[sheet].astype(str)
-                format_sheet.replace("nan", None, inplace=True)
-                format_sheet.to_excel(pd_writer, sheet_name=sheet, index=False)
-            pd_writer.close()
+            self.write_merged_metadata(merged_df, merged_excel_path)
             local_meta_file = merged_excel_path
             return merged_excel_path
         else:
@@ -517,7 +778,7 @@ class DownloadManager:
         allowed_extensions = self.allowed_file_ext
         remote_files_list = [
             os.path.basename(file)
-            for file in self.relecov_sftp.get_file_list(remote_folder)
+            for file in self.remote_tree.get_file_list(remote_folder)
         ]
         filtered_files_list = sorted(
             [fi for fi in remote_files_list if fi.endswith(tuple(allowed_extensions))]
@@ -529,7 +790,7 @@ class DownloadManager:
         for sample in sample_files_dict.keys():
             self.include_new_key(sample=sample)
         metafiles_list = sorted(
-            sum([list(fi.values()) for _, fi in sample_files_dict.items()], [])
+            file for fi in sample_files_dict.values() for file in fi.values()
         )
         if sorted(filtered_files_list) == sorted(metafiles_list):
             log.info("Files in %s match with metadata file", remote_folder)
@@ -539,7 +800,8 @@ class DownloadManager:
             stderr.print(f"[gold1]{log_text % remote_folder}")
             set_list = set(metafiles_list)
             mismatch_files = [fi for fi in filtered_files_list if fi not in set_list]
-            mismatch_rev = [fi for fi in set_list if fi not in filtered_files_list]
+            filtered_set = set(filtered_files_list)
+            mismatch_rev = [fi for fi in set_list if fi not in filtered_set]
 
             if mismatch_files:
                 error_text1 = "Files in folder missing in metadata: %s"
@@ -569,21 +831,30 @@ class DownloadManager:
         """
         stderr.print(f"[blue]Deleting files in remote {remote_folder}...")
         if files is None:
-            files_to_remove = self.relecov_sftp.get_file_list(remote_folder)
+            files_to_remove = self.remote_tree.get_file_list(remote_folder)
         else:
             files_to_remove = files
-        for file in files_to_remove:
-            if skip_seqs is True:
-                if file.endswith(tuple(self.allowed_file_ext)):
-                    continue
-            try:
-                self.relecov_sftp.remove_file(
-                    os.path.join(remote_folder, os.path.basename(file))
-                )
+        if skip_seqs is True:
+            files_to_remove = [
+                fi
+                for fi in files_to_remove
+                if not fi.endswith(tuple(self.allowed_file_ext))
+            ]
+        remote_files = [
+            os.path.join(remote_folder, os.path.basename(fi)) for fi in files_to_remove
+        ]
+        # All the removals are sent at once over the pool of sftp sessions
+        results = self.sftp_pool.run_batch("remove", [(rf,) for rf in remote_files])
+        for file, remote_file, result in zip(files_to_remove, remote_files, results):
+            if isinstance(result, FileNotFoundError):
+                log.error("File %s not found", remote_file)
+                stderr.print("[red]File not found")
+            elif isinstance(result, Exception):
+                log.error(f"Could not delete remote file {file}: {result}")
+                stderr.print(f"Could not delete remote file {file}. Error: {result}")
+            else:
+                self.remote_tree.discard(remote_file)
                 log.info("%s Deleted from remote server", file)
-            except (IOError, PermissionError) as e:
-                log.error(f"Could not delete remote file {file}: {e}")
-                stderr.print(f"Could not delete remote file {file}. Error: {e}")
         return
 
     def rename_remote_folder(self, remote_folder):
@@ -593,7 +864,8 @@ class DownloadManager:
                 log.warning("Remote folder %s was already renamed", remote_folder)
                 return
             try:
-                self.relecov_sftp.rename_file(remote_folder, new_name)
+                if self.relecov_sftp.rename_file(remote_folder, new_name):
+                    self.remote_tree.move(remote_folder, new_name)
                 if self.finished_folders.get(remote_folder):
                     self.finished_folders[new_name] = self.finished_folders.pop(
                         remote_folder
@@ -620,7 +892,8 @@ class DownloadManager:
             if len(remote_folder.replace("./", "").split("/")) >= 2:
                 log.info("Trying to remove %s", remote_folder)
                 try:
-                    self.relecov_sftp.remove_dir(remote_folder)
+                    if self.relecov_sftp.remove_dir(remote_folder):
+                        self.remote_tree.discard(remote_folder)
                     log.info("Successfully removed %s", remote_folder)
                 except (OSError, PermissionError) as e:
                     log_text = f"Could not delete remote {remote_folder}. Error: {e}"
@@ -629,7 +902,7 @@ class DownloadManager:
             else:
                 log.info("%s is a top-level folder. Not removed", remote_folder)
 
-        remote_folder_files = self.relecov_sftp.get_file_list(remote_folder)
+        remote_folder_files = self.remote_tree.get_file_list(remote_folder)
         if remote_folder_files:
             self.rename_remote_folder(remote_folder)
             log_text = f"Remote folder {remote_folder} not empty. Not removed"
@@ -649,6 +922,27 @@ class DownloadManager:
         """
         log.info("Moving remote files to each temporal processing folder")
         stderr.print("[blue]Moving remote files to each temporal processing folder")
+        # Files with the same destination are moved in successive rounds, so the
+        # first one in the list is always the one kept, as in a sequential move
+        move_rounds = []
+        dest_count = {}
+        for folder, files in folders_with_metadata.items():
+            for file in files:
+                if not file.endswith(tuple(self.allowed_file_ext)):
+                    continue
+                file_dest = os.path.join(folder, os.path.basename(file))
+                round_idx = dest_count.get(file_dest, 0)
+                dest_count[file_dest] = round_idx + 1
+                if round_idx == len(move_rounds):
+                    move_rounds.append([])
+                move_rounds[round_idx].append((folder, file, file_dest))
+        move_results = {}
+        for moves in move_rounds:
+            # Paramiko.SSHClient.sftp_open does not have a method to copy files
+            results = self.sftp_pool.run_batch(
+                "rename", [(file, file_dest) for _, file, file_dest in moves]
+            )
+            move_results.update(zip(moves, results))
         for folder, files in folders_with_metadata.items():
             self.current_folder = folder.split("/")[0]
             successful_files = []
@@ -656,17 +950,21 @@ class DownloadManager:
                 if not file.endswith(tuple(self.allowed_file_ext)):
                     continue
                 file_dest = os.path.join(folder, os.path.basename(file))
-                try:
-                    # Paramiko.SSHClient.sftp_open does not have a method to copy files
-                    self.relecov_sftp.rename_file(file, file_dest)
+                result = move_results[(folder, file, file_dest)]
+                if isinstance(result, FileNotFoundError):
+                    error_txt = f"Could not rename {file} to {file_dest}: {result}"
+                    log.error(error_txt)
+                    stderr.print(f"[red]{error_txt}")
+                    successful_files.append(file_dest)
+                elif isinstance(result, OSError):
+                    error_text = "File named %s already in %s. Skipped"
+                    self.include_warning(error_text % (file, self.current_folder))
+                elif isinstance(result, Exception):
+                    error_text = "Error while moving file %s"
+                    self.include_error(error_text % file)
+                else:
+                    self.remote_tree.move(file, file_dest)
                     successful_files.append(file_dest)
-                except OSError:
-                    if file in folders_with_metadata[folder]:
-                        error_text = "File named %s already in %s. Skipped"
-                        self.include_warning(error_text % (file, self.current_folder))
-                    else:
-                        error_text = "Error while moving file %s"
-                        self.include_error(error_text % file)
             folders_with_metadata[folder] = successful_files
         return folders_with_metadata
 
@@ -720,6 +1018,7 @@ class DownloadManager:
                     write_md5.writerows(merged_md5.items())
                 md5_dest = os.path.join(folder, os.path.basename(merged_md5_path))
                 self.relecov_sftp.upload_file(merged_md5_path, md5_dest)
+                self.remote_tree.invalidate(folder)
                 # Remove local files once merged and uploaded
                 os.remove(merged_md5_path)
                 [os.remove(md5_file) for md5_file in downloaded_md5files]
@@ -755,6 +1054,7 @@ class DownloadManager:
     def merge_metadata(self, meta_sheet=None, *metadata_tables):
         """Merge a variable number of metadata dataframes to the first one. Merge them
         only into a certain sheet from a multi-sheet excel file if sheetname is given.
+        All tables are concatenated at once, so each row is only copied once.
 
         Args:
             meta_sheet (str): Name of the sheet containing metadata in excel file
@@ -763,18 +1063,58 @@ class DownloadManager:
         Returns:
             merged_df (pandas.DataFrame): A merged dataframe from the given tables
         """
-        for idx, table in enumerate(metadata_tables):
-            if idx == 0:
-                merged_df = table
-                continue
-            if meta_sheet:
-                merged_df[meta_sheet] = concat(
-                    [merged_df[meta_sheet], table[meta_sheet]], ignore_index=True
-                )
-            else:
-                merged_df = concat([merged_df, table], ignore_index=True)
+        if len(metadata_tables) < 2:
+            return metadata_tables[0] if metadata_tables else None
+        if not meta_sheet:
+            return concat(metadata_tables, ignore_index=True)
+        merged_df = dict(metadata_tables[0])
+        merged_df[meta_sheet] = concat(
+            [table[meta_sheet] for table in metadata_tables], ignore_index=True
+        )
+        duplicated_samples = self.find_duplicated_samples(meta_sheet, metadata_tables)
+        if duplicated_samples:
+            self.include_warning(
+                "Samples found in more than one merged metadata file: %s"
+                % ", ".join(duplicated_samples)
+            )
         return merged_df
 
+    def find_duplicated_samples(self, meta_sheet, metadata_tables):
+        """Find the sample IDs that are present in more than one metadata table
+
+        Args:
+            meta_sheet (str): Name of the sheet containing metadata in excel file
+            metadata_tables (list(dict)): Dicts {name_of_excel_sheet:DataFrame}
+
+        Returns:
+            duplicated_samples (list(str)): Sample IDs found in several tables
+        """
+        sample_id_col = self.metadata_processing.get("sample_id_col")
+        table_ids = [
+            table[meta_sheet][sample_id_col].dropna().astype(str).drop_duplicates()
+            for table in metadata_tables
+            if sample_id_col in table[meta_sheet].columns
+        ]
+        if len(table_ids) < 2:
+            return []
+        all_ids = concat(table_ids, ignore_index=True)
+        return sorted(all_ids[all_ids.duplicated()].unique())
+
+    def write_merged_metadata(self, merged_df, merged_excel_path):
+        """Write every sheet of a merged metadata table to a single excel file
+
+        Args:
+            merged_df (dict(str:pandas.DataFrame)): Dict {name_of_excel_sheet:DataFrame}
+            merged_excel_path (str): Path to the output excel file
+        """
+        pd_writer = ExcelWriter(merged_excel_path, engine="xlsxwriter")
+        for sheet in merged_df.keys():
+            format_sheet = merged_df[sheet].astype(str)
+            format_sheet.replace("nan", None, inplace=True)
+            format_sheet.to_excel(pd_writer, sheet_name=sheet, index=False)
+        pd_writer.close()
+        return
+
     def excel_to_df(self, excel_file, metadata_sheet, header_flag):
         """Read an excel file, return a dict with a dataframe for each sheet in it.
         Process the given sheet with metadata, removing all rows until header is found
@@ -791,8 +1131,18 @@ class DownloadManager:
             excel_df (dict(str:pandas.DataFrame)): Dict {name_of_excel_sheet:DataFrame}
             containing all sheets in the excel file as pandas dataframes.
         """
-        # Get every sheet from the first excel file
-        excel_df = read_excel(excel_file, dtype=str, sheet_name=None)
+        # Get every sheet from the first excel file, parsed only once per content
+        workbook_cache = relecov_tools.workbook_cache.get_default_cache()
+        excel_df = None
+        if workbook_cache is not None:
+            cache_key = workbook_cache.make_key(
+                relecov_tools.utils.calculate_md5(excel_file), "dataframes"
+            )
+            excel_df = workbook_cache.get(cache_key)
+        if excel_df is None:
+            excel_df = read_excel(excel_file, dtype=str, sheet_name=None)
+            if workbook_cache is not None:
+                workbook_cache.put(cache_key, excel_df)
         meta_df = excel_df[metadata_sheet]
         if header_flag in meta_df.columns:
             return excel_df
@@ -823,17 +1173,21 @@ class DownloadManager:
         date_and_time = datetime.today().strftime("%Y%m%d%-H%M%S")
         exts = self.allowed_file_ext
 
-        def upload_merged_df(merged_excel_path, last_main_folder, merged_df):
-            """Upload metadata dataframe merged from all subfolders back to sftp"""
-            self.relecov_sftp.make_dir(last_main_folder)
-            pd_writer = ExcelWriter(merged_excel_path, engine="xlsxwriter")
-            for sheet in merged_df.keys():
-                format_sheet = merged_df[sheet].astype(str)
-                format_sheet.replace("nan", None, inplace=True)
-                format_sheet.to_excel(pd_writer, sheet_name=sheet, index=False)
-            pd_writer.close()
+        def upload_merged_df(merged_excel_path, last_main_folder, lab_tables):
+            """Merge the metadata dataframes from all subfolders of a lab in a single
+            step and upload the resulting excel back to sftp"""
+            current_folder = self.current_folder
+            self.current_folder = last_main_folder.split("/")[0]
+            try:
+                merged_df = self.merge_metadata(metadata_ws, *lab_tables)
+            finally:
+                self.current_folder = current_folder
+            if self.relecov_sftp.make_dir(last_main_folder):
+                self.remote_tree.invalidate(os.path.dirname(last_main_folder) or ".")
+            self.write_merged_metadata(merged_df, merged_excel_path)
             dest = os.path.join(last_main_folder, os.path.basename(merged_excel_path))
             self.relecov_sftp.upload_file(merged_excel_path, dest)
+            self.remote_tree.invalidate(last_main_folder)
             os.remove(merged_excel_path)
             return
 
@@ -860,7 +1214,9 @@ class DownloadManager:
 
         folders_with_metadata = {}
         processed_folders = []
-        merged_df = merged_excel_path = last_main_folder = excel_name = None
+        merged_excel_path = last_main_folder = excel_name = None
+        # Metadata dataframes from every subfolder of the lab being processed
+        lab_tables = []
         log.info("Setting %s remote folders...", str(len(target_folders.keys())))
         stderr.print(f"[blue]Setting {len(target_folders.keys())} remote folders...")
         for folder in sorted(target_folders.keys()):
@@ -889,23 +1245,27 @@ class DownloadManager:
                 log_text = "Trying to merge metadata from %s in %s"
                 log.info(log_text % (main_folder, temp_folder))
                 stderr.print(f"[blue]{log_text % (main_folder, temp_folder)}")
-                if merged_df:
+                if lab_tables:
                     # Write the previous merged metadata df before overriding it
                     try:
-                        upload_merged_df(merged_excel_path, last_main_folder, merged_df)
+                        upload_merged_df(
+                            merged_excel_path, last_main_folder, lab_tables
+                        )
                         folders_with_metadata[last_main_folder].append(excel_name)
                     except OSError:
                         error_text = "Error uploading merged metadata back to sftp: %s"
                         self.include_error(error_text % last_main_folder)
                         del folders_with_metadata[last_main_folder]
+                lab_tables = []
                 try:
-                    merged_df = self.excel_to_df(local_meta, metadata_ws, header_flag)
+                    meta_df = self.excel_to_df(local_meta, metadata_ws, header_flag)
                 except (ParserError, EmptyDataError, MetadataError, KeyError) as e:
                     meta_name = os.path.basename(downloaded_metadata)
                     error_text = "%s skipped. Error while processing excel %s: %s"
                     self.include_error(error_text % (main_folder, meta_name, str(e)))
                     os.remove(local_meta)
                     continue
+                lab_tables.append(meta_df)
                 folders_with_metadata[temp_folder] = []
                 folders_with_metadata[temp_folder].extend(filelist)
                 # rename metadata file to avoid filename duplications
@@ -918,7 +1278,7 @@ class DownloadManager:
                 # If temp_folder has subfolders in it, merge everything
                 folders_with_metadata[temp_folder].extend(filelist)
                 new_df = self.excel_to_df(local_meta, metadata_ws, header_flag)
-                merged_df = self.merge_metadata(metadata_ws, merged_df, new_df)
+                lab_tables.append(new_df)
                 os.remove(local_meta)
             processed_folders.append(folder)
         # End of loop
@@ -926,7 +1286,7 @@ class DownloadManager:
         # Write last dataframe to file once loop is finished
         if folders_with_metadata.get(last_main_folder):
             if excel_name not in folders_with_metadata[last_main_folder]:
-                upload_merged_df(merged_excel_path, last_main_folder, merged_df)
+                upload_merged_df(merged_excel_path, last_main_folder, lab_tables)
                 folders_with_metadata[last_main_folder].append(excel_name)
 
         # Merge md5files and upload them to tmp_processing folder
@@ -944,7 +1304,9 @@ class DownloadManager:
         Returns:
             folders_to_process (dict(str:list)): Dictionary with folders and their files
         """
-        root_directory_list = self.relecov_sftp.list_remote_folders(".", recursive=True)
+        # Single walk of the whole remote tree, used for every listing afterwards
+        self.remote_tree.refresh()
+        root_directory_list = self.remote_tree.list_remote_folders(".", recursive=True)
         clean_root_list = [folder.replace("./", "") for folder in root_directory_list]
         if not root_directory_list:
             log.error("Error while listing folders in remote. Aborting")
@@ -967,19 +1329,21 @@ class DownloadManager:
         folders_to_process = {}
         for targeted_folder in target_folders:
             try:
-                full_folders = self.relecov_sftp.list_remote_folders(
+                full_folders = self.remote_tree.list_remote_folders(
                     targeted_folder, recursive=True
                 )
             except (FileNotFoundError, OSError) as e:
                 log.error(f"Error during sftp listing. {targeted_folder} skipped:", e)
                 continue
             for folder in full_folders:
-                list_files = self.relecov_sftp.get_file_list(folder)
+                list_files = self.remote_tree.get_file_list(folder)
                 if list_files:
                     folders_to_process[folder] = list_files
                 else:
                     log.info("%s is empty", folder)
                     continue
+        if self.incremental:
+            folders_to_process = self.filter_unchanged_folders(folders_to_process)
         if len(folders_to_process) == 0:
             log.info("Exiting process, folders were empty.")
             log.error("There are no files in the selected folders.")
@@ -988,7 +1352,9 @@ class DownloadManager:
         return folders_to_process
 
     def compress_and_update(self, fetched_files, files_to_compress, local_folder):
-        """compress the given list of files_to_compress and update files_list
+        """compress the given list of files_to_compress and update files_list.
+        md5 and gzip integrity of the compressed files are obtained while
+        compressing them.
 
         Args:
             fetched_files (list(str)): list of all downloaded files
@@ -996,25 +1362,33 @@ class DownloadManager:
 
         Returns:
             fetched_files(list(str)): files list including the new compressed files
+            compressed_info(dict): {file.gz: {"md5", "gzip_integrity", "size"}}
         """
-        compressed_files = list()
-        for file in files_to_compress:
-            f_path = os.path.join(local_folder, file)
-            compressed = relecov_tools.utils.compress_file(f_path)
-            if not compressed:
+        compressed_info = dict()
+        compress_paths = [os.path.join(local_folder, fi) for fi in files_to_compress]
+        compressed_status = relecov_tools.utils.compress_files(
+            compress_paths,
+            workers=self.compression_workers,
+            level=int(self.compression.get("level", 9)),
+            block_size=int(self.compression.get("block_size_mb", 16)) * 1048576,
+            executor=self.compression_pool,
+        )
+        for file, f_path in zip(files_to_compress, compress_paths):
+            if not compressed_status.get(f_path):
                 error_text = "Could not compress file %s, file not found" % str(file)
                 self.include_error(error_text, f_path)
                 continue
             # Remove file after compression is completed
-            compressed_files.append(file)
+            compressed_info[file + ".gz"] = compressed_status[f_path]
             try:
                 os.remove(f_path)
             except (FileNotFoundError, PermissionError) as e:
                 log.warning(f"Could not delete file: {e}")
         fetched_files = [
-            (fi + ".gz" if fi in compressed_files else fi) for fi in fetched_files
+            (fi + ".gz" if fi + ".gz" in compressed_info else fi)
+            for fi in fetched_files
         ]
-        return fetched_files
+        return fetched_files, compressed_info
 
     def process_filedict(
         self, valid_filedict, clean_fetchlist, corrupted=[], md5miss=[]
@@ -1033,19 +1407,21 @@ class DownloadManager:
         processed_dict = {}
         error_text = "corrupted or md5 mismatch for %s"
         warning_text = "File %s not found in md5sum. Creating hash"
+        corrupted = set(corrupted)
+        md5miss = set(md5miss)
+        clean_fetchset = set(clean_fetchlist)
+        # Each file is the last one in clean_fetchlist whose name contains the value
+        fetch_index = relecov_tools.utils.FileNameIndex(clean_fetchlist)
         for sample, vals in valid_filedict.items():
             processed_dict[sample] = {}
             for key, val in vals.items():
-                processed_dict[sample][key] = None
                 if val in corrupted:
                     self.include_error(error_text % val, sample=sample)
                 if val in md5miss:
                     self.include_warning(warning_text % val, sample=sample)
-                for file in clean_fetchlist:
-                    if val in file:
-                        processed_dict[sample][key] = file
+                processed_dict[sample][key] = fetch_index.find_last(val)
             # remove sample if it has missing files
-            if not all(x in clean_fetchlist for x in processed_dict[sample].values()):
+            if not all(x in clean_fetchset for x in processed_dict[sample].values()):
                 if not corrupted:
                     error_text = "Sample %s skipped: missing files in sftp"
                     self.include_error(str(error_text % sample), sample=sample)
@@ -1053,6 +1429,70 @@ class DownloadManager:
                 del processed_dict[sample]
         return processed_dict
 
+    def plan_downloads(self, target_folders):
+        """Schedule the folders to download so that all of them fit in the free
+        space of platform_storage_folder, using the sizes of the remote files.
+        Uncompressed sequence files count twice, as they are compressed locally.
+        Folders that do not fit are skipped and reported before any download.
+
+        Args:
+            target_folders (dict(str:list)): folders to download and their files
+
+        Returns:
+            scheduled_folders (dict(str:list)): folders that fit in local disk,
+            in the order they should be downloaded
+        """
+        storage_path = os.path.abspath(self.platform_storage_folder)
+        while not os.path.exists(storage_path):
+            storage_path = os.path.dirname(storage_path)
+        try:
+            free_space = shutil.disk_usage(storage_path).free
+        except OSError as e:
+            log.warning("Could not get free space in %s: %s", storage_path, e)
+            return target_folders
+        margin = int(self.download_planning.get("free_space_margin_mb", 0)) * 1048576
+        available = free_space - margin
+        folder_sizes = {}
+        for folder in target_folders:
+            try:
+                remote_sizes = self.remote_tree.get_file_sizes(folder)
+            except OSError as e:
+                log.warning("Could not get file sizes in %s: %s", folder, e)
+                remote_sizes = {}
+            folder_sizes[folder] = sum(remote_sizes.values()) + sum(
+                size
+                for name, size in remote_sizes.items()
+                if name.endswith(tuple(self.allowed_file_ext))
+                and not name.endswith((".gz", ".bam"))
+            )
+        schedule = list(target_folders.keys())
+        if self.download_planning.get("smallest_first"):
+            # Complete as many labs as possible if there is no room for all
+            schedule.sort(key=lambda folder: folder_sizes[folder])
+        scheduled_folders = {}
+        for folder in schedule:
+            if folder_sizes[folder] > available:
+                self.current_folder = folder.split("/")[0]
+                error_text = "Folder %s skipped: needs %s, only %s free"
+                error_text = error_text % (
+                    folder,
+                    relecov_tools.utils.format_size(folder_sizes[folder]),
+                    relecov_tools.utils.format_size(max(available, 0)),
+                )
+                stderr.print(f"[red]{error_text}")
+                self.include_error(error_text)
+                continue
+            available -= folder_sizes[folder]
+            scheduled_folders[folder] = target_folders[folder]
+        total_size = sum(folder_sizes[folder] for folder in scheduled_folders)
+        log.info(
+            "Scheduled %s of %s folders to download, %s in total",
+            len(scheduled_folders),
+            len(target_folders),
+            relecov_tools.utils.format_size(total_size),
+        )
+        return scheduled_folders
+
     def download(self, target_folders):
         """Manages all the different functions to download files, verify their
         integrity and create initial json with filepaths and md5 hashes
@@ -1067,172 +1507,262 @@ class DownloadManager:
         except OSError as e:
             log.error("You do not have permissions to create folder %s", e)
             sys.exit(1)
-        folders_to_download = target_folders
-        for folder in folders_to_download.keys():
-            self.current_folder = folder.split("/")[0]
-            # Close previously open connection to avoid timeouts
-            try:
-                self.relecov_sftp.close_connection()
-            except paramiko.SSHException:
-                pass
-            # Check if the connection has been closed due to time limit
-            self.relecov_sftp.open_connection()
-            log.info("Processing folder %s", folder)
-            stderr.print("[blue]Processing folder " + folder)
-            # Validate that the files are the ones described in metadata.
-
-            local_folder = self.create_local_folder(folder)
+        folders_to_download = list(target_folders.keys())
+        if self.parallel_folders <= 1 or len(folders_to_download) <= 1:
+            for folder in folders_to_download:
+                finished_files = self.process_folder(folder)
+                if finished_files is not None:
+                    self.finished_folders[folder] = finished_files
+            return
+        # Folders from the same lab share their logs, so they are processed by
+        # the same task one after another
+        lab_folders = {}
+        for folder in folders_to_download:
+            lab_folders.setdefault(folder.split("/")[0], []).append(folder)
+        log.info(
+            "Processing %s folders, %s at a time",
+            len(folders_to_download),
+            self.parallel_folders,
+        )
+        with ThreadPoolExecutor(max_workers=self.parallel_folders) as executor:
+            task_results = list(
+                executor.map(self.process_folder_task, lab_folders.values())
+            )
+        # Logs and results are gathered in the same order as in a serial run
+        finished_folders = {}
+        for task_logs, task_finished in task_results:
+            self.logsum.logs.update(task_logs)
+            finished_folders.update(task_finished)
+        for folder in folders_to_download:
+            if folder in finished_folders:
+                self.finished_folders[folder] = finished_folders[folder]
+        return
+
+    def process_folder_task(self, folders):
+        """Process a group of folders in a worker thread, with its own sftp
+        session and log summary so its state is not shared with other tasks
+
+        Args:
+            folders (list(str)): remote folders from the same lab
+
+        Returns:
+            task_logs(dict): log summary entries of the processed folders
+            finished_folders(dict): {folder: list of finished files}
+        """
+        lab_key = str(folders[0].split("/")[0]).replace("./", "")
+        task_logsum = LogSum(output_location=self.platform_storage_folder)
+        if lab_key in self.logsum.logs:
+            task_logsum.logs[lab_key] = copy.deepcopy(self.logsum.logs[lab_key])
+        finished_folders = {}
+        with self.folder_sessions.session() as sftp_session:
+            self.task_context.active = True
+            self.relecov_sftp = sftp_session
+            self.logsum = task_logsum
             try:
-                valid_filedict, meta_file = self.validate_remote_files(
-                    folder, local_folder
-                )
-            except (FileNotFoundError, IOError, PermissionError, MetadataError) as fail:
-                log.error(fail)
-                stderr.print(f"[red]{fail}, skipped")
-                self.include_error(fail)
-                continue
-            # Get the files in each folder
-            files_to_download = [
-                fi for vals in valid_filedict.values() for fi in vals.values()
-            ]
-            fetched_files = self.get_remote_folder_files(
-                folder, local_folder, files_to_download
+                for folder in folders:
+                    finished_files = self.process_folder(folder)
+                    if finished_files is not None:
+                        finished_folders[folder] = finished_files
+            finally:
+                vars(self.task_context).clear()
+        return task_logsum.logs, finished_folders
+
+    def process_folder(self, folder):
+        """Download a remote folder, verify the integrity of its files and create
+        the initial json with filepaths and md5 hashes
+
+        Args:
+            folder (str): remote folder to be processed
+
+        Returns:
+            finished_files(list(str)): processed files. None if folder was skipped
+        """
+        self.current_folder = folder.split("/")[0]
+        # Reuse the connection unless it was closed, e.g. due to time limit
+        self.relecov_sftp.ensure_connection()
+        log.info("Processing folder %s", folder)
+        stderr.print("[blue]Processing folder " + folder)
+        # Validate that the files are the ones described in metadata.
+
+        local_folder = self.create_local_folder(folder)
+        try:
+            valid_filedict, meta_file = self.validate_remote_files(folder, local_folder)
+        except (FileNotFoundError, IOError, PermissionError, MetadataError) as fail:
+            log.error(fail)
+            stderr.print(f"[red]{fail}, skipped")
+            self.include_error(fail)
+            return None
+        # Get the files in each folder
+        files_to_download = [
+            fi for vals in valid_filedict.values() for fi in vals.values()
+        ]
+        fetched_files = self.get_remote_folder_files(
+            folder, local_folder, files_to_download
+        )
+        if not fetched_files:
+            error_text = "No files could be downloaded in folder %s" % str(folder)
+            stderr.print(f"{error_text}")
+            self.include_error(error_text)
+            return None
+        log.info("Finished download for folder: %s", folder)
+        stderr.print(f"Finished download for folder {folder}")
+        downloaded_files = list(fetched_files.keys())
+        # md5 hashes computed while files were being downloaded
+        local_hashes = {fi: info["md5"] for fi, info in fetched_files.items()}
+        remote_md5sum = self.find_remote_md5sum(folder)
+        if remote_md5sum:
+            # Get the md5checksum to validate integrity of files after download
+            fetched_md5 = os.path.join(local_folder, os.path.basename(remote_md5sum))
+            self.relecov_sftp.get_from_sftp(file=remote_md5sum, destination=fetched_md5)
+            successful_files, corrupted = self.verify_md5_checksum(
+                local_folder, fetched_files, fetched_md5, local_hashes
             )
-            if not fetched_files:
-                error_text = "No files could be downloaded in folder %s" % str(folder)
-                stderr.print(f"{error_text}")
-                self.include_error(error_text)
-                continue
-            log.info("Finished download for folder: %s", folder)
-            stderr.print(f"Finished download for folder {folder}")
-            remote_md5sum = self.find_remote_md5sum(folder)
-            if remote_md5sum:
-                # Get the md5checksum to validate integrity of files after download
-                fetched_md5 = os.path.join(
-                    local_folder, os.path.basename(remote_md5sum)
+            # try to download the files again to discard errors during download
+            if corrupted:
+                stderr.print("[gold1]Found md5 mismatches, downloading again...")
+                for corr_file in corrupted:
+                    relecov_tools.utils.safe_remove(
+                        os.path.join(local_folder, corr_file)
+                    )
+                refetched_files = self.get_remote_folder_files(
+                    folder, local_folder, corrupted
                 )
-                self.relecov_sftp.get_from_sftp(
-                    file=remote_md5sum, destination=fetched_md5
+                fetched_files.update(refetched_files)
+                local_hashes.update(
+                    {fi: info["md5"] for fi, info in refetched_files.items()}
                 )
-                successful_files, corrupted = self.verify_md5_checksum(
-                    local_folder, fetched_files, fetched_md5
+                saved_files, corrupted = self.verify_md5_checksum(
+                    local_folder, corrupted, fetched_md5, local_hashes
                 )
-                # try to download the files again to discard errors during download
+                if saved_files:
+                    successful_files.extend(saved_files)
                 if corrupted:
-                    stderr.print("[gold1]Found md5 mismatches, downloading again...")
-                    self.get_remote_folder_files(folder, local_folder, corrupted)
-                    saved_files, corrupted = self.verify_md5_checksum(
-                        local_folder, corrupted, fetched_md5
-                    )
-                    if saved_files:
-                        successful_files.extend(saved_files)
-                    if corrupted:
-                        corr_fold = os.path.join(local_folder, "corrupted")
-                        os.mkdir(corr_fold)
-                        error_text = "Found corrupted files: %s. Moved to: %s"
-                        stderr.print(f"[red]{error_text % (str(corrupted), corr_fold)}")
-                        self.include_warning(error_text % (str(corrupted), corr_fold))
-                        for corr_file in corrupted:
-                            path = os.path.join(local_folder, corr_file)
-                            try:
-                                os.rename(path, os.path.join(corr_fold, corr_file))
-                            except (FileNotFoundError, PermissionError, OSError) as e:
-                                error_text = (
-                                    "Could not move corrupted file %s to %s: %s"
-                                )
-                                log.error(error_text % (path, corr_fold, e))
-                                stderr.print(
-                                    f"[red]{error_text % (path, corr_fold, e)}"
-                                )
-                        if self.abort_if_md5_mismatch:
-                            error_text = "Stop processing %s due to corrupted files."
-                            stderr.print(f"[red]{error_text % folder}")
-                            self.include_error(error_text % "folder")
-                            relecov_tools.utils.delete_local_folder(local_folder)
-                            continue
-                hash_dict = relecov_tools.utils.read_md5_checksum(
-                    fetched_md5, self.avoidable_characters
-                )
-                log.info("Finished md5 check for folder: %s", folder)
-                stderr.print(f"[blue]Finished md5 verification for folder {folder}")
-            else:
-                corrupted = []
-                error_text = "No single md5sum file could be found in %s" % folder
-                stderr.print(f"[red]{error_text}")
-                self.include_warning(error_text)
+                    corr_fold = os.path.join(local_folder, "corrupted")
+                    os.mkdir(corr_fold)
+                    error_text = "Found corrupted files: %s. Moved to: %s"
+                    stderr.print(f"[red]{error_text % (str(corrupted), corr_fold)}")
+                    self.include_warning(error_text % (str(corrupted), corr_fold))
+                    for corr_file in corrupted:
+                        path = os.path.join(local_folder, corr_file)
+                        try:
+                            os.rename(path, os.path.join(corr_fold, corr_file))
+                        except (FileNotFoundError, PermissionError, OSError) as e:
+                            error_text = "Could not move corrupted file %s to %s: %s"
+                            log.error(error_text % (path, corr_fold, e))
+                            stderr.print(f"[red]{error_text % (path, corr_fold, e)}")
+                    if self.abort_if_md5_mismatch:
+                        error_text = "Stop processing %s due to corrupted files."
+                        stderr.print(f"[red]{error_text % folder}")
+                        self.include_error(error_text % "folder")
+                        relecov_tools.utils.delete_local_folder(local_folder)
+                        return None
+            hash_dict = relecov_tools.utils.read_md5_checksum(
+                fetched_md5, self.avoidable_characters
+            )
+            log.info("Finished md5 check for folder: %s", folder)
+            stderr.print(f"[blue]Finished md5 verification for folder {folder}")
+        else:
+            corrupted = []
+            error_text = "No single md5sum file could be found in %s" % folder
+            stderr.print(f"[red]{error_text}")
+            self.include_warning(error_text)
 
-            seqs_fetchlist = [
-                fi for fi in fetched_files if fi.endswith(tuple(self.allowed_file_ext))
-            ]
-            seqs_fetchlist = [fi for fi in seqs_fetchlist if fi not in corrupted]
-            # Checking for uncompressed files
-            files_to_compress = [
-                fi
-                for fi in seqs_fetchlist
-                if not fi.endswith(".gz") and not fi.endswith(".bam")
-            ]
-            if files_to_compress:
-                comp_files = str(len(files_to_compress))
-                log.info("Found %s uncompressed files, compressing...", comp_files)
-                stderr.print(f"Found {comp_files} uncompressed files, compressing...")
-                clean_fetchlist = self.compress_and_update(
-                    seqs_fetchlist, files_to_compress, local_folder
-                )
-            else:
-                clean_fetchlist = seqs_fetchlist
-            clean_pathlist = [os.path.join(local_folder, fi) for fi in clean_fetchlist]
-            not_md5sum = []
-            if remote_md5sum:
-                # Get hashes from provided md5sum, create them for those not provided
-                files_md5_dict = {}
-                for path in clean_pathlist:
-                    f_name = os.path.basename(path)
-                    if f_name in successful_files:
-                        files_md5_dict[f_name] = hash_dict[f_name]
-                    elif f_name in corrupted:
-                        clean_fetchlist.remove(f_name)
-                    else:
-                        if not str(f_name).rstrip(".gz") in files_to_compress:
-                            error_text = "File %s not found in md5sum. Creating hash"
-                            log.warning(error_text % f_name)
-                            not_md5sum.append(f_name)
-                        else:
-                            log.info("File %s was compressed, creating md5hash", f_name)
-                        files_md5_dict[f_name] = relecov_tools.utils.calculate_md5(path)
-            else:
-                md5_hashes = [
-                    relecov_tools.utils.calculate_md5(path) for path in clean_pathlist
-                ]
-                files_md5_dict = dict(zip(clean_fetchlist, md5_hashes))
-            for file in files_md5_dict.keys():
-                full_f_path = os.path.join(local_folder, file)
-                if not relecov_tools.utils.check_gzip_integrity(full_f_path):
-                    corrupted.append(file)
-            files_md5_dict = {
-                x: y for x, y in files_md5_dict.items() if x not in corrupted
-            }
-            processed_filedict = self.process_filedict(
-                valid_filedict, clean_fetchlist, corrupted=corrupted, md5miss=not_md5sum
+        seqs_fetchlist = [
+            fi for fi in fetched_files if fi.endswith(tuple(self.allowed_file_ext))
+        ]
+        seqs_fetchlist = [fi for fi in seqs_fetchlist if fi not in corrupted]
+        # Checking for uncompressed files
+        files_to_compress = [
+            fi
+            for fi in seqs_fetchlist
+            if not fi.endswith(".gz") and not fi.endswith(".bam")
+        ]
+        if files_to_compress:
+            comp_files = str(len(files_to_compress))
+            log.info("Found %s uncompressed files, compressing...", comp_files)
+            stderr.print(f"Found {comp_files} uncompressed files, compressing...")
+            clean_fetchlist, compressed_info = self.compress_and_update(
+                seqs_fetchlist, files_to_compress, local_folder
             )
-            self.create_files_with_metadata_info(
-                local_folder, processed_filedict, files_md5_dict, meta_file
+            # Hash and integrity of compressed files need no extra reads
+            fetched_files.update(compressed_info)
+            local_hashes.update(
+                {fi: info["md5"] for fi, info in compressed_info.items()}
             )
-            if self.logsum.logs.get(self.current_folder):
-                self.logsum.logs[self.current_folder].update({"path": local_folder})
-                try:
-                    folder_basename = os.path.basename(local_folder.rstrip("/"))
-                    log_name = folder_basename + "_download_log_summary.json"
-                    self.logsum.create_error_summary(
-                        filepath=os.path.join(local_folder, log_name),
-                        logs={
-                            self.current_folder: self.logsum.logs[self.current_folder]
-                        },
-                    )
-                except Exception as e:
-                    log.error("Could not create logsum for %s: %s" % (folder, str(e)))
-            stderr.print(f"[green]Finished processing {folder}")
-            self.finished_folders[folder] = list(files_md5_dict.keys())
-        return
+        else:
+            clean_fetchlist = seqs_fetchlist
+        clean_pathlist = [os.path.join(local_folder, fi) for fi in clean_fetchlist]
+        not_md5sum = []
+        if remote_md5sum:
+            # Get hashes from provided md5sum, create them for those not provided
+            files_md5_dict = {}
+            for path in clean_pathlist:
+                f_name = os.path.basename(path)
+                if f_name in successful_files:
+                    files_md5_dict[f_name] = hash_dict[f_name]
+                elif f_name in corrupted:
+                    clean_fetchlist.remove(f_name)
+                else:
+                    if not str(f_name).rstrip(".gz") in files_to_compress:
+                        error_text = "File %s not found in md5sum. Creating hash"
+                        log.warning(error_text % f_name)
+                        not_md5sum.append(f_name)
+                    else:
+                        log.info("File %s was compressed, using its md5hash", f_name)
+                    files_md5_dict[f_name] = local_hashes.get(f_name)
+        else:
+            files_md5_dict = {fi: local_hashes.get(fi) for fi in clean_fetchlist}
+        # Hash all the files whose md5 was not obtained during download at once
+        missing_hashes = [
+            os.path.join(local_folder, fi)
+            for fi, md5 in files_md5_dict.items()
+            if md5 is None
+        ]
+        if missing_hashes:
+            new_hashes = relecov_tools.utils.calculate_md5_batch(missing_hashes)
+            for path, md5 in new_hashes.items():
+                files_md5_dict[os.path.basename(path)] = md5
+        for file in files_md5_dict.keys():
+            full_f_path = os.path.join(local_folder, file)
+            # Integrity of gzip files is already checked while downloading them
+            gzip_integrity = fetched_files.get(file, {}).get("gzip_integrity")
+            if gzip_integrity is None:
+                gzip_integrity = relecov_tools.utils.check_gzip_integrity(full_f_path)
+            if not gzip_integrity:
+                corrupted.append(file)
+        files_md5_dict = {x: y for x, y in files_md5_dict.items() if x not in corrupted}
+        processed_filedict = self.process_filedict(
+            valid_filedict, clean_fetchlist, corrupted=corrupted, md5miss=not_md5sum
+        )
+        self.create_files_with_metadata_info(
+            local_folder, processed_filedict, files_md5_dict, meta_file
+        )
+        if self.logsum.logs.get(self.current_folder):
+            self.logsum.logs[self.current_folder].update({"path": local_folder})
+            try:
+                folder_basename = os.path.basename(local_folder.rstrip("/"))
+                log_name = folder_basename + "_download_log_summary.json"
+                # Transfer metrics are only included in the folder log summary
+                folder_logs = dict(self.logsum.logs[self.current_folder])
+                metrics = relecov_tools.transfer_metrics.get_default_metrics()
+                folder_logs["transfer_metrics"] = metrics.folder_report(local_folder)
+                self.logsum.create_error_summary(
+                    filepath=os.path.join(local_folder, log_name),
+                    logs={self.current_folder: folder_logs},
+                )
+            except Exception as e:
+                log.error("Could not create logsum for %s: %s" % (folder, str(e)))
+        self.record_synced_files(
+            folder,
+            local_folder,
+            {
+                fi: local_hashes.get(fi)
+                for fi in downloaded_files
+                if fi not in corrupted
+            },
+        )
+        stderr.print(f"[green]Finished processing {folder}")
+        return list(files_md5_dict.keys())
 
     def include_new_key(self, sample=None):
         self.logsum.feed_key(key=self.current_folder, sample=sample)
@@ -1246,6 +1776,54 @@ class DownloadManager:
         self.logsum.add_warning(key=self.current_folder, entry=entry, sample=sample)
         return
 
+    def log_connection_stats(self):
+        """Log the number of sftp connections, reconnections and time spent on
+        them, for the main session and the pool of download sessions"""
+        for name, stats in (
+            ("main", self.relecov_sftp.connection_stats),
+            ("pool", self.sftp_pool.get_connection_stats()),
+            ("folder task", self.folder_sessions.get_connection_stats()),
+        ):
+            if not stats:
+                continue
+            log.info(
+                "SFTP %s session(s): %s connections, %s reconnections (%s failed), "
+                "%.2f seconds connecting"
+                % (
+                    name,
+                    stats["connections"],
+                    stats["reconnections"],
+                    stats["failed_reconnections"],
+                    stats["connect_seconds"],
+                )
+            )
+        return
+
+    def export_transfer_metrics(self):
+        """Log the throughput of each operation and write the transfer metrics to
+        the json and Prometheus textfile outputs defined in configuration, if any.
+        Relative paths are placed in platform_storage_folder."""
+        metrics = relecov_tools.transfer_metrics.get_default_metrics()
+        metrics.log_summary()
+        json_file = self.metrics_config.get("json_file")
+        prometheus_file = self.metrics_config.get("prometheus_file")
+        try:
+            if json_file:
+                json_file = os.path.join(self.platform_storage_folder, json_file)
+                metrics.write_json(json_file)
+                log.info("Transfer metrics saved in %s", json_file)
+            if prometheus_file:
+                prometheus_file = os.path.join(
+                    self.platform_storage_folder, prometheus_file
+                )
+                metrics.write_prometheus(
+                    prometheus_file, root_folder=self.platform_storage_folder
+                )
+                log.info("Transfer metrics saved in %s", prometheus_file)
+        except OSError as e:
+            log.error("Could not save transfer metrics: %s", e)
+        return
+
     def execute_process(self):
         """Executes different processes depending on the download_option"""
         if not self.relecov_sftp.open_connection():
@@ -1259,13 +1837,24 @@ class DownloadManager:
             for folder in processed_folders:
                 self.current_folder = folder
                 self.delete_remote_files(folder)
+            # Folders are removed once empty, subfolders before their parents
+            for folder in self.sort_deepest_first(processed_folders):
+                self.current_folder = folder
                 self.clean_remote_folder(folder)
                 stderr.print(f"Delete process finished in {folder}")
         else:
             target_folders, processed_folders = self.merge_subfolders(target_folders)
-            self.download(target_folders)
+            target_folders = self.plan_downloads(target_folders)
+            # A single pool for every folder, even if several are processed at once
+            with relecov_tools.utils.create_compression_pool(
+                self.compression_workers
+            ) as compression_pool:
+                self.compression_pool = compression_pool
+                try:
+                    self.download(target_folders)
+                finally:
+                    self.compression_pool = None
 
-        self.relecov_sftp.close_connection()
         stderr.print(f"Processed {len(processed_folders)} folders: {processed_folders}")
         if self.logsum.logs:
             log.info("Printing process summary to %s", self.platform_storage_folder)
@@ -1277,12 +1866,27 @@ class DownloadManager:
         if self.download_option == "download_clean":
             for folder in processed_folders:
                 self.delete_remote_files(folder, skip_seqs=True)
+            for folder in self.sort_deepest_first(processed_folders):
                 self.clean_remote_folder(folder)
             folders_to_clean = copy.deepcopy(self.finished_folders)
             for folder, downloaded_files in folders_to_clean.items():
                 self.delete_remote_files(folder, files=downloaded_files)
                 self.delete_remote_files(folder, skip_seqs=True)
+            for folder in self.sort_deepest_first(folders_to_clean.keys()):
                 self.clean_remote_folder(folder)
                 stderr.print(f"Delete process finished in remote {folder}")
+        self.log_connection_stats()
+        self.export_transfer_metrics()
+        self.sftp_pool.close_all()
+        self.folder_sessions.close_all()
+        self.relecov_sftp.close_connection()
         stderr.print("Finished execution")
         return
+
+    def sort_deepest_first(self, remote_folders):
+        """Sort remote folders so every subfolder comes before its parent folder"""
+        return sorted(
+            remote_folders,
+            key=lambda folder: len(folder.strip("/").split("/")),
+            reverse=True,
+        )
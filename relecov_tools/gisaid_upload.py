@@ -7,6 +7,7 @@ import pandas as pd
 import os
 
 import relecov_tools.utils
+import relecov_tools.config_json
 from Bio import SeqIO
 from relecov_tools.config_json import ConfigJson
 
@@ -156,14 +157,8 @@ class GisaidUpload:
             if field not in col_df:
                 df_data.insert(4, field, "")
 
-        config_lab_json = ConfigJson()
-        lab_json_conf = config_lab_json.get_topic_data(
-            "lab_metadata", "laboratory_data"
-        )
-        lab_json_file = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)), "conf", lab_json_conf["file"]
-        )
-        lab_json = relecov_tools.utils.read_json_file(lab_json_file)
+        lab_json_conf = config_json.get_topic_data("lab_metadata", "laboratory_data")
+        lab_json = relecov_tools.config_json.get_conf_json(lab_json_conf["file"])
         for lab in lab_json:
             for i in range(len(df_data)):
                 if lab["collecting_institution"] == df_data["covv_orig_lab"][i]:
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+import logging
+import os
+import sqlite3
+import threading
+import time
+from relecov_tools.config_json import ConfigJson
+
+log = logging.getLogger(__name__)
+
+
+class HashCache:
+    """Persistent md5 cache stored in a SQLite file. Each entry is keyed by the real
+    path of the file together with its size, modification time (ns) and inode, so
+    an entry is automatically discarded when any of these values changes.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.realpath(db_path)), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS md5_cache (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    md5 TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+
+    def get(self, file_name, file_stat=None):
+        """Return the cached md5 for the given file if its stat data did not change
+
+        Args:
+            file_name (str): path to the file
+            file_stat (os.stat_result, optional): stat of the file if already known
+
+        Returns:
+            md5 (str): cached md5 hash. None if not cached or outdated
+        """
+        path = os.path.realpath(file_name)
+        if file_stat is None:
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, inode, md5 FROM md5_cache WHERE path = ?",
+                (path,),
+            ).fetchone()
+            if row is None:
+                return None
+            size, mtime_ns, inode, md5 = row
+            with self.connection:
+                if (size, mtime_ns, inode) != (
+                    file_stat.st_size,
+                    file_stat.st_mtime_ns,
+                    file_stat.st_ino,
+                ):
+                    log.debug("Cached md5 for %s is outdated", path)
+                    self.connection.execute(
+                        "DELETE FROM md5_cache WHERE path = ?", (path,)
+                    )
+                    return None
+                self.connection.execute(
+                    "UPDATE md5_cache SET last_used = ? WHERE path = ?",
+                    (time.time(), path),
+                )
+        return md5
+
+    def put(self, file_name, md5, file_stat=None):
+        """Store the md5 of a file together with its current stat data
+
+        Args:
+            file_name (str): path to the file
+            md5 (str): md5 hash of the file
+            file_stat (os.stat_result, optional): stat of the file when it was
+            hashed. If it changed since then, the entry is not stored.
+        """
+        path = os.path.realpath(file_name)
+        try:
+            current_stat = os.stat(path)
+        except OSError:
+            return
+        if file_stat is not None and (
+            file_stat.st_size,
+            file_stat.st_mtime_ns,
+            file_stat.st_ino,
+        ) != (current_stat.st_size, current_stat.st_mtime_ns, current_stat.st_ino):
+            log.debug("%s changed while being hashed. Not cached", path)
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO md5_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    current_stat.st_size,
+                    current_stat.st_mtime_ns,
+                    current_stat.st_ino,
+                    md5,
+                    time.time(),
+                ),
+            )
+        return
+
+    def prune(self, max_age_days=None):
+        """Remove entries for files that no longer exist and, if max_age_days is
+        given, those that have not been used in that number of days
+
+        Args:
+            max_age_days (int, optional): Max days since an entry was last used
+
+        Returns:
+            pruned (int): number of removed entries
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, last_used FROM md5_cache"
+            ).fetchall()
+            if max_age_days is not None:
+                min_last_used = time.time() - float(max_age_days) * 86400
+            else:
+                min_last_used = None
+            to_remove = [
+                (path,)
+                for path, last_used in rows
+                if not os.path.exists(path)
+                or (min_last_used is not None and last_used < min_last_used)
+            ]
+            with self.connection:
+                self.connection.executemany(
+                    "DELETE FROM md5_cache WHERE path = ?", to_remove
+                )
+        if to_remove:
+            log.info(
+                "Pruned %s entries from hash cache %s", len(to_remove), self.db_path
+            )
+        return len(to_remove)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+        return
+
+
+_default_cache = None
+_default_cache_folder = None
+_default_cache_lock = threading.Lock()
+
+
+def set_default_cache(folder=None):
+    """Enable the hash cache used by default in every md5 calculation, located in
+    the given folder. If no folder is given, platform_storage_folder from
+    configuration.json is used. The cache is not used unless it is enabled, and
+    it is only opened, creating its folder, the first time it is needed.
+
+    Args:
+        folder (str, optional): folder where the cache file is stored
+    """
+    global _default_cache, _default_cache_folder
+    config_json = ConfigJson()
+    cache_config = config_json.get_configuration("hash_cache") or {}
+    with _default_cache_lock:
+        if _default_cache is not None:
+            _default_cache.close()
+            _default_cache = None
+        _default_cache_folder = None
+        if str(cache_config.get("enabled", "True")) != "True":
+            return
+        if folder is None:
+            folder = config_json.get_topic_data(
+                "sftp_handle", "platform_storage_folder"
+            )
+        _default_cache_folder = folder
+    return
+
+
+def get_default_cache():
+    """Return the default hash cache, opening it the first time it is needed.
+    Old entries are pruned when it is opened, following hash_cache config.
+
+    Returns:
+        cache (HashCache): the default cache. None if it was not enabled with
+        set_default_cache() or could not be opened
+    """
+    global _default_cache, _default_cache_folder
+    if _default_cache is not None or _default_cache_folder is None:
+        return _default_cache
+    cache_config = ConfigJson().get_configuration("hash_cache") or {}
+    with _default_cache_lock:
+        if _default_cache is not None or _default_cache_folder is None:
+            return _default_cache
+        cache_file = cache_config.get("cache_filename", ".relecov_hash_cache.sqlite")
+        try:
+            _default_cache = HashCache(os.path.join(_default_cache_folder, cache_file))
+            prune_after_days = cache_config.get("prune_after_days")
+            if prune_after_days:
+                _default_cache.prune(max_age_days=prune_after_days)
+        except (OSError, sqlite3.Error) as e:
+            log.warning("Could not open hash cache in %s: %s", _default_cache_folder, e)
+            _default_cache = None
+            # Do not try to open it again for every file
+            _default_cache_folder = None
+    return _default_cache
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 import logging
+from collections import Counter
+from itertools import chain
 import rich.console
 from jsonschema import Draft202012Validator
 import sys
@@ -7,6 +9,7 @@ import os
 import openpyxl
 
 import relecov_tools.utils
+import relecov_tools.compiled_schema
 import relecov_tools.assets.schema_utils.jsonschema_draft
 from relecov_tools.config_json import ConfigJson
 from relecov_tools.log_summary import LogSum
@@ -33,7 +36,10 @@ class SchemaValidation:
                 os.path.dirname(os.path.realpath(__file__)), "schema", schema_name
             )
 
-        self.json_schema = relecov_tools.utils.read_json_file(json_schema_file)
+        self.compiled_schema = relecov_tools.compiled_schema.load_schema(
+            json_schema_file
+        )
+        self.json_schema = self.compiled_schema.schema
 
         if json_data_file is None:
             json_data_file = relecov_tools.utils.prompt_path(
@@ -98,46 +104,50 @@ class SchemaValidation:
 
         # create validator
         validator = Draft202012Validator(self.json_schema)
-        schema_props = self.json_schema["properties"]
+        field_labels = self.compiled_schema.property_to_label
+        # Missing required fields are found by their error message
+        required_messages = {
+            f"{field!r} is a required property": field
+            for field in self.compiled_schema.required
+        }
 
         validated_json_data = []
         invalid_json = []
-        errors = {}
+        errors = Counter()
         error_keys = {}
         if self.sample_id_field is None:
             log_text = f"Logs keys set to None. Reason: {self.SAMPLE_FIELD_ERROR}"
             self.logsum.add_warning(sample=self.sample_id_field, entry=log_text)
         stderr.print("[blue] Start processing the json file")
         for item_row in self.json_data:
-            # validate(instance=item_row, schema=json_schema)
             sample_id_value = item_row.get(self.sample_id_field)
-            if validator.is_valid(item_row):
+            # Each row is only validated once, errors are produced as needed
+            row_errors = validator.iter_errors(item_row)
+            first_error = next(row_errors, None)
+            if first_error is None:
                 validated_json_data.append(item_row)
                 self.logsum.feed_key(sample=sample_id_value)
-            else:
-                # Count error types
-                for error in validator.iter_errors(item_row):
-                    if error.validator == "required":
+                continue
+            # Count error types
+            for error in chain([first_error], row_errors):
+                if error.validator == "required":
+                    error_field = required_messages.get(error.message)
+                    if error_field is None:
                         error_field = [
                             f for f in error.validator_value if f in error.message
                         ][0]
-                    else:
-                        error_field = error.absolute_path[0]
-                    try:
-                        err_field_label = schema_props[error_field]["label"]
-                    except KeyError:
-                        log.error("Could not extract label for %s" % error_field)
-                        err_field_label = error_field
-                    error.message.replace(error_field, err_field_label)
-                    error_text = f"Error in column {err_field_label}: {error.message}"
-                    error_keys[error.message] = error_field
-                    if error.message in errors:
-                        errors[error.message] += 1
-                    else:
-                        errors[error.message] = 1
-                    self.logsum.add_error(sample=sample_id_value, entry=error_text)
-                # append row with errors
-                invalid_json.append(item_row)
+                else:
+                    error_field = error.absolute_path[0]
+                err_field_label = field_labels.get(error_field)
+                if err_field_label is None:
+                    log.error("Could not extract label for %s" % error_field)
+                    err_field_label = error_field
+                error_text = f"Error in column {err_field_label}: {error.message}"
+                error_keys[error.message] = error_field
+                errors[error.message] += 1
+                self.logsum.add_error(sample=sample_id_value, entry=error_text)
+            # append row with errors
+            invalid_json.append(item_row)
 
         # Summarize errors
         stderr.print("[blue] --------------------")
@@ -3,7 +3,6 @@ import logging
 import json
 import os
 import inspect
-import copy
 import re
 
 import openpyxl
@@ -88,29 +87,34 @@ class LogSum:
             sample (str, optional): Name of a sample within key if the log is for it
             one sample instead of the whole key/folder. Defaults to None.
         """
-        feed_dict = OrderedDict({"valid": True, "errors": [], "warnings": []})
         # Removing strange characters
         current_key = str(key).replace("./", "")
         entry, sample = (str(entry), str(sample))
-        if current_key not in self.logs.keys():
-            self.logs[current_key] = copy.deepcopy(feed_dict)
+        if current_key not in self.logs:
+            self.logs[current_key] = self.new_feed_dict()
             self.logs[current_key]["samples"] = OrderedDict()
         if self.path:
-            self.logs[current_key].update({"path": str(self.path)})
+            self.logs[current_key]["path"] = str(self.path)
         if path is not None:
-            self.logs[current_key].update({"path": str(path)})
+            self.logs[current_key]["path"] = str(path)
+        samples = self.logs[current_key]["samples"]
         if log_type is None:
-            if sample != "None" and sample not in self.logs[current_key]["samples"]:
-                self.logs[current_key]["samples"][sample] = copy.deepcopy(feed_dict)
+            if sample != "None" and sample not in samples:
+                samples[sample] = self.new_feed_dict()
             return
         if sample == "None":
             self.logs[current_key][log_type].append(entry)
         else:
-            if sample not in self.logs[current_key]["samples"].keys():
-                self.logs[current_key]["samples"][sample] = copy.deepcopy(feed_dict)
-            self.logs[current_key]["samples"][sample][log_type].append(entry)
+            if sample not in samples:
+                samples[sample] = self.new_feed_dict()
+            samples[sample][log_type].append(entry)
         return
 
+    @staticmethod
+    def new_feed_dict():
+        """Return the empty structure holding the logs of a key or a sample"""
+        return OrderedDict({"valid": True, "errors": [], "warnings": []})
+
     def prepare_final_logs(self, logs):
         """Sets valid field to false if any errors were found for each key/sample
 
@@ -12,6 +12,7 @@ import sys
 
 # import jsonschema
 import relecov_tools.utils
+import relecov_tools.compiled_schema
 
 log = logging.getLogger(__name__)
 stderr = rich.console.Console(
@@ -46,16 +47,14 @@ class MappingSchema:
                     "[red] Relecov schema " + relecov_schema + " does not exist"
                 )
                 exit(1)
-        rel_schema_json = relecov_tools.utils.read_json_file(relecov_schema)
-        try:
-            Draft202012Validator.check_schema(rel_schema_json)
-        except jsonschema.ValidationError:
+        self.compiled_schema = relecov_tools.compiled_schema.load_schema(relecov_schema)
+        if self.compiled_schema.draft_error is not None:
             log.error("Relecov schema does not fulfill Draft 202012 Validation ")
             stderr.print(
                 "[red] Relecov schema does not fulfill Draft 202012 Validation"
             )
             sys.exit(1)
-        self.relecov_schema = rel_schema_json
+        self.relecov_schema = self.compiled_schema.schema
 
         if json_file is None:
             json_file = relecov_tools.utils.prompt_path(
@@ -114,11 +113,11 @@ class MappingSchema:
         with open(self.schema_file, "r") as fh:
             self.mapped_to_schema = json.load(fh)
 
-        self.ontology = {}
-        for key, values in self.relecov_schema["properties"].items():
-            if values["ontology"] == "0":
-                continue
-            self.ontology[values["ontology"]] = key
+        self.ontology = {
+            ontology: key
+            for ontology, key in self.compiled_schema.ontology_to_property.items()
+            if ontology != "0"
+        }
         self.output_folder = output_folder
 
         if os.path.exists(os.path.join(output_folder, "mapping_errors.log")):
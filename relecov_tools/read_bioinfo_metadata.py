@@ -601,6 +601,12 @@ class BioinfoMetadata:
         """
         method_name = f"{self.add_bioinfo_files_path.__name__}"
         sample_name_error = 0
+        # Index the files of each configuration item once for all the samples
+        files_indexes = {
+            key: relecov_tools.utils.FileNameIndex(values)
+            for key, values in files_found_dict.items()
+            if values
+        }
         for row in j_data:
             row["bioinfo_metadata_file"] = self.out_filename
             if not row.get("sequencing_sample_id"):
@@ -611,13 +617,10 @@ class BioinfoMetadata:
                 )
                 continue
             sample_name = row["sequencing_sample_id"]
-            for key, values in files_found_dict.items():
+            for key in files_found_dict.keys():
                 file_path = "Not Provided [GENEPIO:0001668]"
-                if values:  # Check if value is not empty
-                    for file in values:
-                        if sample_name in file:
-                            file_path = file
-                            break  # Exit loop if match found
+                if key in files_indexes:
+                    file_path = files_indexes[key].find_first(sample_name, file_path)
                 path_key = f"{self.software_name}_filepath_{key}"
                 row[path_key] = file_path
                 if self.software_config[key].get("extract"):
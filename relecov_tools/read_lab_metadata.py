@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import json
 import logging
 import rich.console
 import os
@@ -7,6 +6,8 @@ import sys
 import re
 from datetime import datetime as dtime
 import relecov_tools.utils
+import relecov_tools.compiled_schema
+import relecov_tools.config_json
 from relecov_tools.config_json import ConfigJson
 import relecov_tools.json_schema
 from relecov_tools.log_summary import LogSum
@@ -75,19 +76,16 @@ class RelecovMetadata:
         )
         self.configuration = config_json
 
-        with open(relecov_sch_path, "r") as fh:
-            self.relecov_sch_json = json.load(fh)
-        self.label_prop_dict = {}
-
-        for prop, values in self.relecov_sch_json["properties"].items():
-            try:
-                self.label_prop_dict[values["label"]] = prop
-            except KeyError:
-                log.warning("Property %s does not have 'label' attribute", prop)
-                stderr.print(
-                    "[orange]Property " + prop + " does not have 'label' attribute"
-                )
-                continue
+        self.compiled_schema = relecov_tools.compiled_schema.load_schema(
+            relecov_sch_path
+        )
+        self.relecov_sch_json = self.compiled_schema.schema
+        self.label_prop_dict = self.compiled_schema.label_to_property
+        for prop in self.compiled_schema.unlabeled_properties:
+            log.warning("Property %s does not have 'label' attribute", prop)
+            stderr.print(
+                "[orange]Property " + prop + " does not have 'label' attribute"
+            )
         self.date = dtime.now().strftime("%Y%m%d%H%M%S")
         self.json_req_files = config_json.get_topic_data(
             "lab_metadata", "lab_metadata_req_json"
@@ -112,13 +110,10 @@ class RelecovMetadata:
             its file names, locations and md5
         """
 
-        def safely_calculate_md5(file):
-            """Check file md5, but return Not Provided if file does not exist"""
-            log.info("Generating md5 hash for %s...", str(file))
-            try:
-                return relecov_tools.utils.calculate_md5(file)
-            except IOError:
-                return "Not Provided [GENEPIO:0001668]"
+        def report_md5_progress(done, total, file):
+            log.info("Generated md5 hash for %s (%s/%s)", str(file), done, total)
+            if done == total or done % 10 == 0:
+                stderr.print(f"[blue]Generated md5 hashes for {done}/{total} files")
 
         # The files are and md5file are supposed to be located together
         dir_path = self.files_folder
@@ -137,6 +132,8 @@ class RelecovMetadata:
             log.warning("No md5sum file found.")
             log.warning("Generating new md5 hashes. This might take a while...")
         j_data = {}
+        # (files_dict, md5 field, path) for the files missing in md5sum file
+        pending_hashes = []
         no_fastq_error = "No R1 fastq file was given for sample %s in metadata"
         for sample in clean_metadata_rows:
             sample_id = str(sample.get("sequencing_sample_id"))
@@ -159,12 +156,13 @@ class RelecovMetadata:
                     sample=sample_id, entry="Provided R1 file not found after download"
                 )
                 continue
+            sample_hashes = []
             if r1_md5:
                 files_dict["fastq_r1_md5"] = r1_md5
             else:
-                files_dict["fastq_r1_md5"] = safely_calculate_md5(
-                    os.path.join(dir_path, r1_file)
-                )
+                files_dict["fastq_r1_md5"] = None
+                r1_path = os.path.join(dir_path, r1_file)
+                sample_hashes.append((files_dict, "fastq_r1_md5", r1_path))
             if r2_file:
                 files_dict["sequence_file_R2_fastq"] = r2_file
                 files_dict["r2_fastq_filepath"] = dir_path
@@ -177,10 +175,21 @@ class RelecovMetadata:
                 if r2_md5:
                     files_dict["fastq_r2_md5"] = r2_md5
                 else:
-                    files_dict["fastq_r2_md5"] = safely_calculate_md5(
-                        os.path.join(dir_path, r1_file)
-                    )
+                    files_dict["fastq_r2_md5"] = None
+                    r2_path = os.path.join(dir_path, r2_file)
+                    sample_hashes.append((files_dict, "fastq_r2_md5", r2_path))
+            pending_hashes.extend(sample_hashes)
             j_data[sample_id] = files_dict
+        if pending_hashes:
+            # Each file is hashed once, hashing several files at the same time
+            new_hashes = relecov_tools.utils.calculate_md5_batch(
+                [path for _, _, path in pending_hashes],
+                progress_callback=report_md5_progress,
+            )
+            for files_dict, md5_field, path in pending_hashes:
+                files_dict[md5_field] = new_hashes.get(
+                    path, "Not Provided [GENEPIO:0001668]"
+                )
         if not any(val for val in j_data.values()):
             raise FileNotFoundError(f"No files found for the samples in {dir_path}")
         try:
@@ -268,16 +277,7 @@ class RelecovMetadata:
         which have an enum property value, replace the value for the one
         that is defined in the schema.
         """
-        enum_dict = {}
-        for prop, values in self.relecov_sch_json["properties"].items():
-            if "enum" in values:
-                enum_dict[prop] = {}
-                for enum in values["enum"]:
-                    go_match = re.search(r"(.+) \[\w+:.*", enum)
-                    if go_match:
-                        enum_dict[prop][go_match.group(1)] = enum
-                    else:
-                        enum_dict[prop][enum] = enum
+        enum_dict = self.compiled_schema.enum_values
         ontology_errors = {}
         for idx in range(len(m_data)):
             for key, e_values in enum_dict.items():
@@ -301,36 +301,48 @@ class RelecovMetadata:
         return m_data
 
     def process_from_json(self, m_data, json_fields):
-        """Find the labels that are missing in the file to match the given schema."""
+        """Find the labels that are missing in the file to match the given schema.
+        Every distinct value of map_field is looked up once in the json data and
+        the matching records are then joined to all the samples at once.
+        """
         map_field = json_fields["map_field"]
         col_name = self.relecov_sch_json["properties"].get(map_field).get("label")
         json_data = json_fields["j_data"]
-        for idx in range(len(m_data)):
-            sample_id = str(m_data[idx].get("sequencing_sample_id"))
-            if m_data[idx].get(map_field):
-                try:
-                    m_data[idx].update(json_data[m_data[idx][map_field]])
-                except KeyError as error:
-                    clean_error = re.sub("[\[].*?[\]]", "", str(error.args[0]))
-                    if str(clean_error).lower().strip() == "not provided":
-                        log_text = (
-                            f"Label {col_name} was not provided in sample "
-                            + f"{sample_id}, auto-completing with Not Provided"
-                        )
-                        self.logsum.add_warning(sample=sample_id, entry=log_text)
-                    else:
-                        log_text = (
-                            f"Unknown field value {error} for json data: "
-                            + f"{str(col_name)} in sample {sample_id}. Skipped"
-                        )
-                        self.logsum.add_warning(sample=sample_id, entry=log_text)
-                        continue
-                    # TODO: Include Not Provided as a configuration field
-                    fields_to_add = {
-                        x: "Not Provided [GENEPIO:0001668]"
-                        for x in json_fields["adding_fields"]
-                    }
-                    m_data[idx].update(fields_to_add)
+        # TODO: Include Not Provided as a configuration field
+        fields_to_add = {
+            x: "Not Provided [GENEPIO:0001668]" for x in json_fields["adding_fields"]
+        }
+        map_values = {row[map_field] for row in m_data if row.get(map_field)}
+        records = {}
+        not_provided_values = set()
+        for value in map_values:
+            if value in json_data:
+                records[value] = json_data[value]
+                continue
+            clean_value = re.sub("[\[].*?[\]]", "", str(value))
+            if str(clean_value).lower().strip() == "not provided":
+                not_provided_values.add(value)
+        for row in m_data:
+            value = row.get(map_field)
+            if not value:
+                continue
+            if value in records:
+                row.update(records[value])
+                continue
+            sample_id = str(row.get("sequencing_sample_id"))
+            if value in not_provided_values:
+                log_text = (
+                    f"Label {col_name} was not provided in sample "
+                    + f"{sample_id}, auto-completing with Not Provided"
+                )
+                self.logsum.add_warning(sample=sample_id, entry=log_text)
+                row.update(fields_to_add)
+            else:
+                log_text = (
+                    f"Unknown field value {KeyError(value)} for json data: "
+                    + f"{str(col_name)} in sample {sample_id}. Skipped"
+                )
+                self.logsum.add_warning(sample=sample_id, entry=log_text)
         return m_data
 
     def adding_fields(self, metadata):
@@ -338,11 +350,12 @@ class RelecovMetadata:
 
         for key, values in self.json_req_files.items():
             stderr.print(f"[blue]Processing {key}")
-            f_path = os.path.join(
-                os.path.dirname(os.path.realpath(__file__)), "conf", values["file"]
+            # Configuration is shared, so the json data is added to a copy
+            json_fields = dict(values)
+            json_fields["j_data"] = relecov_tools.config_json.get_conf_json(
+                values["file"]
             )
-            values["j_data"] = relecov_tools.utils.read_json_file(f_path)
-            metadata = self.process_from_json(metadata, values)
+            metadata = self.process_from_json(metadata, json_fields)
             stderr.print(f"[green]Processed {key}")
 
         # Include Sample information data from sample json file
@@ -365,10 +378,7 @@ class RelecovMetadata:
         """
         c_files = {}
         for item, value in self.json_files.items():
-            f_path = os.path.join(
-                os.path.dirname(os.path.realpath(__file__)), "conf", value
-            )
-            c_files[item] = relecov_tools.utils.read_json_file(f_path)
+            c_files[item] = relecov_tools.config_json.get_conf_json(value)
         return c_files
 
     def read_metadata_file(self):
@@ -380,9 +390,14 @@ class RelecovMetadata:
         header_flag = self.metadata_processing.get("header_flag")
         sample_id_col = self.metadata_processing.get("sample_id_col")
         self.alternative_heading = False
+        max_empty_rows = self.metadata_processing.get("max_empty_rows")
         try:
             ws_metadata_lab, heading_row_number = relecov_tools.utils.read_excel_file(
-                self.metadata_file, meta_sheet, header_flag, leave_empty=False
+                self.metadata_file,
+                meta_sheet,
+                header_flag,
+                leave_empty=False,
+                max_empty_rows=max_empty_rows,
             )
         except KeyError:
             self.alternative_heading = True
@@ -392,17 +407,69 @@ class RelecovMetadata:
             logtxt = f"No excel sheet named {meta_sheet}. Using {alt_sheet}"
             stderr.print(f"[yellow]{logtxt}")
             ws_metadata_lab, heading_row_number = relecov_tools.utils.read_excel_file(
-                self.metadata_file, alt_sheet, header_flag, leave_empty=False
+                self.metadata_file,
+                alt_sheet,
+                header_flag,
+                leave_empty=False,
+                max_empty_rows=max_empty_rows,
             )
         alt_header_dict = self.configuration.get_topic_data(
             "lab_metadata", "alt_heading_equivalences"
         )
-        valid_metadata_rows = []
-        included_sample_ids = []
+        metadata_rows, sample_ids = self.filter_metadata_rows(
+            ws_metadata_lab, sample_id_col, heading_row_number
+        )
+        if not metadata_rows:
+            return []
+        # Each column is normalised at once, keeping its logs with their rows
+        row_logs = [[] for _ in metadata_rows]
+        property_columns = []
+        for key in metadata_rows[0].keys():
+            # skip the first column of the Metadata lab file
+            if header_flag in key:
+                continue
+            prop = self.label_prop_dict.get(key)
+            if prop is None and self.alternative_heading:
+                prop = self.label_prop_dict.get(alt_header_dict.get(key))
+            column = [row[key] for row in metadata_rows]
+            values = self.normalise_metadata_column(
+                key, prop, column, sample_ids, row_logs
+            )
+            property_columns.append((prop, values))
+        # Logs are included row by row, in the same order as they were found
+        for logs in row_logs:
+            for add_log, sample_id, log_text, print_text in logs:
+                add_log(sample=sample_id, entry=log_text)
+                if print_text:
+                    stderr.print(f"[red]{print_text}")
+        valid_metadata_rows = [
+            {
+                prop: values[idx]
+                for prop, values in property_columns
+                if values[idx] is not None
+            }
+            for idx in range(len(metadata_rows))
+        ]
+        return valid_metadata_rows
+
+    def filter_metadata_rows(self, ws_metadata_lab, sample_id_col, heading_row_number):
+        """Select the rows with a valid and unique sample id, in the same order
+
+        Args:
+            ws_metadata_lab (list(dict)): rows read from metadata excel file
+            sample_id_col (str): name of the column with the sample id
+            heading_row_number (int): number of the header row in the sheet
+
+        Returns:
+            metadata_rows (list(dict)): rows for the samples to be processed
+            sample_ids (list(str)): sample id of each selected row
+        """
+        metadata_rows = []
+        sample_ids = []
+        included_sample_ids = set()
         row_number = heading_row_number
         for row in ws_metadata_lab:
             row_number += 1
-            property_row = {}
             try:
                 sample_id = str(row[sample_id_col]).strip()
             except KeyError:
@@ -417,63 +484,72 @@ class RelecovMetadata:
                 self.logsum.add_warning(entry=log_text)
                 stderr.print(f"[red]{log_text}")
                 continue
-            included_sample_ids.append(sample_id)
-            for key in row.keys():
-                # skip the first column of the Metadata lab file
-                if header_flag in key:
-                    continue
-                if row[key] is None or "not provided" in str(row[key]).lower():
-                    log_text = f"{key} not provided for sample {sample_id}"
-                    self.logsum.add_warning(sample=sample_id, entry=log_text)
-                    continue
-                if "date" in key.lower():
-                    # Check if date is a string. Format YYYY/MM/DD to YYYY-MM-DD
-                    pattern = r"^\d{4}[-/.]\d{2}[-/.]\d{2}"
-                    if isinstance(row[key], dtime):
-                        row[key] = str(row[key].date())
-                    elif re.match(pattern, str(row[key])):
-                        row[key] = str(row[key]).replace("/", "-").replace(".", "-")
-                        row[key] = re.match(pattern, row[key]).group(0)
-                    else:
-                        try:
-                            row[key] = str(int(float(str(row[key]))))
-                            log.info("Date given as an integer. Understood as a year")
-                        except (ValueError, TypeError):
-                            log_text = f"Invalid date format in {key}: {row[key]}"
-                            self.logsum.add_error(sample=sample_id, entry=log_text)
-                            stderr.print(f"[red]{log_text} for sample {sample_id}")
-                            continue
-                elif "sample id" in key.lower():
-                    if isinstance(row[key], float) or isinstance(row[key], int):
-                        row[key] = str(int(row[key]))
+            included_sample_ids.add(sample_id)
+            metadata_rows.append(row)
+            sample_ids.append(sample_id)
+        return metadata_rows, sample_ids
+
+    def normalise_metadata_column(self, key, prop, column, sample_ids, row_logs):
+        """Convert all the values of a metadata column to strings. Dates are given
+        as YYYY-MM-DD, numbers are converted to text and non-provided values are
+        discarded. The kind of conversion is only decided once per column.
+
+        Args:
+            key (str): label of the column in metadata excel
+            prop (str): schema property for the label, None if it has no mapping
+            column (list): value of the column in each row
+            sample_ids (list(str)): sample id of each row
+            row_logs (list(list)): logs found in each row, extended with the ones
+            found in this column as (log method, sample, text, text to print)
+
+        Returns:
+            values (list(str)): normalised value for each row, None if discarded
+        """
+        is_date = "date" in key.lower()
+        is_sample_id = not is_date and "sample id" in key.lower()
+        date_pattern = re.compile(r"^\d{4}[-/.]\d{2}[-/.]\d{2}")
+        add_warning = self.logsum.add_warning
+        add_error = self.logsum.add_error
+        values = []
+        for idx, value in enumerate(column):
+            sample_id = sample_ids[idx]
+            if value is None or "not provided" in str(value).lower():
+                log_text = f"{key} not provided for sample {sample_id}"
+                row_logs[idx].append((add_warning, sample_id, log_text, None))
+                values.append(None)
+                continue
+            if is_date:
+                # Check if date is a string. Format YYYY/MM/DD to YYYY-MM-DD
+                date_match = date_pattern.match(str(value))
+                if isinstance(value, dtime):
+                    value = str(value.date())
+                elif date_match:
+                    value = date_match.group(0).replace("/", "-").replace(".", "-")
                 else:
-                    if isinstance(row[key], float) or isinstance(row[key], int):
-                        row[key] = str(row[key])
-                if "date" not in key.lower() and isinstance(row[key], dtime):
-                    logtxt = f"Non-date field {key} provided as date. Parsed as int"
-                    self.logsum.add_warning(sample=sample_id, entry=logtxt)
-                    row[key] = str(relecov_tools.utils.excel_date_to_num(row[key]))
-                if self.alternative_heading:
-                    alt_key = alt_header_dict.get(key)
-                if row[key] is not None or "not provided" not in str(row[key]).lower():
                     try:
-                        property_row[self.label_prop_dict[key]] = str(row[key]).strip()
-                    except KeyError as e:
-                        if self.alternative_heading:
-                            try:
-                                property_row[self.label_prop_dict[alt_key]] = str(
-                                    row[key]
-                                ).strip()
-                                continue
-                            except KeyError:
-                                pass
-                        log_text = f"Error when mapping the label {str(e)}"
-                        self.logsum.add_error(sample=sample_id, entry=log_text)
-                        stderr.print(f"[red]{log_text}")
+                        value = str(int(float(str(value))))
+                        log.info("Date given as an integer. Understood as a year")
+                    except (ValueError, TypeError):
+                        log_text = f"Invalid date format in {key}: {value}"
+                        print_text = f"{log_text} for sample {sample_id}"
+                        row_logs[idx].append(
+                            (add_error, sample_id, log_text, print_text)
+                        )
+                        values.append(None)
                         continue
-            valid_metadata_rows.append(property_row)
-
-        return valid_metadata_rows
+            elif isinstance(value, (float, int)):
+                value = str(int(value)) if is_sample_id else str(value)
+            elif isinstance(value, dtime):
+                logtxt = f"Non-date field {key} provided as date. Parsed as int"
+                row_logs[idx].append((add_warning, sample_id, logtxt, None))
+                value = str(relecov_tools.utils.excel_date_to_num(value))
+            if prop is None:
+                log_text = f"Error when mapping the label {str(KeyError(key))}"
+                row_logs[idx].append((add_error, sample_id, log_text, log_text))
+                values.append(None)
+                continue
+            values.append(str(value).strip())
+        return values
 
     def create_metadata_json(self):
         stderr.print("[blue]Reading Lab Metadata Excel File")
@@ -1,14 +1,31 @@
+import hashlib
 import logging
 import os
+import functools
 import paramiko
+import posixpath
+import queue
+import random
 import rich.console
+import socket
 import stat
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from relecov_tools.config_json import ConfigJson
+import relecov_tools.hash_cache
+import relecov_tools.transfer_metrics
 import relecov_tools.utils
 
 log = logging.getLogger(__name__)
+# Size of the blocks read from remote files when streaming downloads
+STREAM_BLOCK_SIZE = 1048576
+# Errors caused by the network or the ssh transport, worth reconnecting for
+TRANSPORT_ERRORS = (paramiko.SSHException, EOFError, ConnectionError, socket.timeout)
+# Max seconds to wait before reconnecting, whatever the number of retries
+MAX_RECONNECT_WAIT = 60
 stderr = rich.console.Console(
     stderr=True,
     style="dim",
@@ -17,6 +34,34 @@ stderr = rich.console.Console(
 )
 
 
+class BandwidthLimiter:
+    """Token bucket capping the download rate of every sftp session sharing it.
+    Each received block consumes its size in tokens, and tokens are refilled at
+    bytes_per_second, allowing bursts of up to one second of transfer.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.capacity = self.rate
+        self.tokens = self.capacity
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n_bytes):
+        """Wait until n_bytes can be transferred without exceeding the rate"""
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last_update
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.last_update = now
+            # Tokens may go below zero, the debt is paid by waiting
+            self.tokens -= n_bytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return
+
+
 class SftpRelecov:
     """Class to handle SFTP connection with remote server. It uses paramiko library to establish
     the connection. The class can be used to upload and download files from the remote server.
@@ -31,7 +76,11 @@ class SftpRelecov:
     }
     """
 
+    # Whether all the sessions from new_session() share this same connection
+    multiplexed = False
+
     def __init__(self, conf_file=None, username=None, password=None):
+        self.conf_file = conf_file
         if conf_file is None:
             config_json = ConfigJson()
             self.sftp_server = config_json.get_topic_data("sftp_handle", "sftp_server")
@@ -56,24 +105,69 @@ class SftpRelecov:
                 sys.exit(1)
         self.user_name = username
         self.password = password
+        self.keepalive_interval = int(
+            ConfigJson().get_topic_data("sftp_handle", "keepalive_interval") or 0
+        )
+        self.connection_stats = {
+            "connections": 0,
+            "reconnections": 0,
+            "failed_reconnections": 0,
+            "connect_seconds": 0.0,
+        }
+        # Reconnections already attributed to a transfer in transfer metrics
+        self.recorded_reconnections = 0
+        # Optional cap on download rate, in megabits per second
+        bandwidth_limit = float(
+            ConfigJson().get_topic_data("sftp_handle", "bandwidth_limit_mbps") or 0
+        )
+        if bandwidth_limit > 0:
+            self.bandwidth_limiter = BandwidthLimiter(bandwidth_limit * 125000)
+        else:
+            self.bandwidth_limiter = None
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
+    def new_session(self):
+        """Create a new, not yet connected, SftpRelecov instance sharing the same
+        server, port and credentials as this one but using its own transport.
+
+        Returns:
+            session (SftpRelecov): independent sftp session
+        """
+        session = SftpRelecov(self.conf_file, self.user_name, self.password)
+        session.sftp_server = self.sftp_server
+        session.sftp_port = self.sftp_port
+        # The bandwidth cap applies to all the sessions together
+        session.bandwidth_limiter = self.bandwidth_limiter
+        return session
+
     def reconnect_if_fail(n_times, sleep_time):
+        """Retry the decorated method n_times, reconnecting before each retry, only
+        if it failed due to a transport error. Other errors are raised directly.
+        The first retry is immediate, then the wait grows exponentially from
+        sleep_time, with random jitter so parallel sessions do not reconnect at
+        the same time.
+        """
+
         def decorator(func):
+            @functools.wraps(func)
             def retrier(self, *args, **kwargs):
-                more_sleep_time = 0
-                retries = 0
-                while retries < n_times:
+                for retry in range(n_times):
                     try:
                         return func(self, *args, **kwargs)
-                    except Exception:
-                        retries += 1
-                        log.info("Connection lost. Trying to reconnect...")
-                        time.sleep(more_sleep_time)
-                        # Try extending sleep time before reconnecting in each step
-                        more_sleep_time = more_sleep_time + sleep_time
-                        self.open_connection()
+                    except Exception as e:
+                        if not self.is_transport_error(e):
+                            raise
+                        # First reconnection is immediate, then wait longer each time
+                        wait = min(MAX_RECONNECT_WAIT, sleep_time * 2 ** (retry - 1))
+                        wait = random.uniform(wait / 2, wait) if retry else 0
+                        log.info(
+                            "Connection lost (%s). Reconnecting in %.1f seconds...",
+                            e,
+                            wait,
+                        )
+                        time.sleep(wait)
+                        self.reconnect()
                 else:
                     log.error("Could not reconnect to remote client")
                 return func(self, *args, **kwargs)
@@ -85,6 +179,7 @@ class SftpRelecov:
     def open_connection(self):
         """Establishing sftp connection"""
         log.info("Setting credentials for SFTP connection with remote server")
+        start = time.perf_counter()
         self.client.connect(
             hostname=self.sftp_server,
             port=self.sftp_port,
@@ -93,6 +188,9 @@ class SftpRelecov:
             allow_agent=False,
             look_for_keys=False,
         )
+        if self.keepalive_interval:
+            # Avoid idle connections being dropped by the server or firewalls
+            self.client.get_transport().set_keepalive(self.keepalive_interval)
         try:
             log.info("Trying to establish SFTP connection")
             self.sftp = self.client.open_sftp()
@@ -100,9 +198,58 @@ class SftpRelecov:
             log.error("Could not establish SFTP connection: %s", e)
             stderr.print("[red]Could not establish SFTP connection")
             return False
+        self.connection_stats["connections"] += 1
+        self.connection_stats["connect_seconds"] += time.perf_counter() - start
         return True
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    def is_alive(self):
+        """Health check: True if the ssh transport and the sftp channel are open"""
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if not transport.is_authenticated():
+            return False
+        sftp = getattr(self, "sftp", None)
+        return sftp is not None and not sftp.get_channel().closed
+
+    def is_transport_error(self, error):
+        """Check if an error was caused by the connection and not by the operation
+        itself, e.g. a missing file. Authentication errors are not retried.
+        """
+        if isinstance(error, paramiko.AuthenticationException):
+            return False
+        if isinstance(error, TRANSPORT_ERRORS):
+            return True
+        return not self.is_alive()
+
+    def reconnect(self):
+        """Close the current transport and open a new connection
+
+        Returns:
+            bool: True if the connection could be established again
+        """
+        self.connection_stats["reconnections"] += 1
+        try:
+            self.client.close()
+            if self.open_connection():
+                return True
+        except (*TRANSPORT_ERRORS, OSError) as e:
+            log.warning("Could not reconnect to %s: %s", self.sftp_server, e)
+        self.connection_stats["failed_reconnections"] += 1
+        return False
+
+    def ensure_connection(self):
+        """Reuse the current connection if it is healthy, reconnect otherwise
+
+        Returns:
+            bool: True if the connection is ready to be used
+        """
+        if self.is_alive():
+            return True
+        log.info("SFTP connection is not active, reconnecting")
+        return self.reconnect()
+
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def list_remote_folders(self, folder_name, recursive=False):
         """Creates a directories list from the given client remote path
 
@@ -150,10 +297,9 @@ class SftpRelecov:
             ]
         except AttributeError:
             return False
-        self.close_connection()
         return directory_list
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def get_file_list(self, folder_name):
         """Return a tuple with file name and directory path from remote
 
@@ -173,7 +319,219 @@ class SftpRelecov:
         ]
         return file_list
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    @reconnect_if_fail(n_times=3, sleep_time=5)
+    def get_file_sizes(self, folder_name):
+        """Return the size in bytes of each regular file in the remote folder
+
+        Args:
+            folder_name (str): name of folder in remote repository
+
+        Returns:
+            file_sizes (dict(str:int)): {file basename: size in bytes}
+        """
+        content_list = self.sftp.listdir_attr(folder_name)
+        file_sizes = {
+            content.filename: content.st_size
+            for content in content_list
+            if stat.S_ISREG(content.st_mode)
+        }
+        return file_sizes
+
+    @reconnect_if_fail(n_times=3, sleep_time=5)
+    def get_dir_attributes(self, folder_name):
+        """Return the attributes of every item in a remote folder
+
+        Args:
+            folder_name (str): name of folder in remote repository
+
+        Returns:
+            attribute_list (list(paramiko.SFTPAttributes)): items in remote folder
+        """
+        return self.sftp.listdir_attr(folder_name)
+
+    @reconnect_if_fail(n_times=3, sleep_time=5)
+    def walk_remote_tree(self, folder_name="."):
+        """List a remote folder and all its subfolders, sending a single listdir
+        request per directory
+
+        Args:
+            folder_name (str, optional): root of the walk. Defaults to "."
+
+        Returns:
+            tree (dict(str:list)): {folder path: list(paramiko.SFTPAttributes)}
+        """
+        log.info("Walking remote tree from %s", folder_name)
+        tree = {}
+        pending = [folder_name]
+        while pending:
+            current_folder = pending.pop(0)
+            attribute_list = self.sftp.listdir_attr(current_folder)
+            tree[current_folder] = attribute_list
+            pending.extend(
+                os.path.join(current_folder, attribute.filename)
+                for attribute in attribute_list
+                if stat.S_ISDIR(attribute.st_mode)
+            )
+        return tree
+
+    def stream_file(self, file, destination):
+        """Download a remote file block by block, feeding each received block into
+        an md5 hasher and, for gzip files, into a gzip integrity checker while it
+        is written to the local destination.
+
+        Data is written to '<destination>.part' first. If that file already exists
+        from an interrupted transfer, download is resumed from its current size.
+        The file is only renamed to its final name once its size matches the
+        size of the remote file.
+
+        Args:
+            file (str): path of the file in remote sftp
+            destination (str): local path of the file after download
+
+        Raises:
+            IOError: If the downloaded file size does not match the remote one
+
+        Returns:
+            stream_info (dict): {"md5": hexdigest, "gzip_integrity": bool or None
+            if the file is not gzipped, "size": number of bytes downloaded}
+        """
+        start = time.perf_counter()
+        md5_hash = hashlib.md5()
+        if file.endswith(".gz"):
+            gzip_checker = relecov_tools.utils.GzipIntegrityChecker()
+        else:
+            gzip_checker = None
+        part_file = destination + ".part"
+        with self.sftp.open(file, "rb") as remote_fh:
+            file_size = remote_fh.stat().st_size
+            offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+            if offset > file_size:
+                log.warning("Partial file %s larger than remote. Removed", part_file)
+                os.remove(part_file)
+                offset = 0
+            if offset:
+                log.info("Resuming download of %s from byte %s", file, offset)
+                # Previously downloaded data must be included in hash and checks
+                with open(part_file, "rb") as part_fh:
+                    while True:
+                        block = part_fh.read(STREAM_BLOCK_SIZE)
+                        if not block:
+                            break
+                        md5_hash.update(block)
+                        if gzip_checker:
+                            gzip_checker.update(block)
+                remote_fh.seek(offset)
+            with open(part_file, "ab") as local_fh:
+                for block in self.read_remote_blocks(remote_fh, offset, file_size):
+                    local_fh.write(block)
+                    md5_hash.update(block)
+                    if gzip_checker:
+                        gzip_checker.update(block)
+        local_size = os.path.getsize(part_file)
+        if local_size != file_size:
+            raise IOError(
+                f"Incomplete download of {file}: {local_size} of {file_size} bytes"
+            )
+        os.replace(part_file, destination)
+        self.record_transfer(
+            "download", destination, file_size - offset, time.perf_counter() - start
+        )
+        hash_cache = relecov_tools.hash_cache.get_default_cache()
+        if hash_cache is not None:
+            hash_cache.put(destination, md5_hash.hexdigest())
+        stream_info = {
+            "md5": md5_hash.hexdigest(),
+            "gzip_integrity": gzip_checker.is_valid() if gzip_checker else None,
+            "size": file_size,
+        }
+        return stream_info
+
+    def record_transfer(self, operation, path, n_bytes, seconds):
+        """Record a transfer in the default transfer metrics, including the
+        reconnections of this session since its previous recorded transfer
+
+        Args:
+            operation (str): "download" or "upload"
+            path (str): local path of the transferred file
+            n_bytes (int): bytes transferred
+            seconds (float): duration of the transfer
+        """
+        reconnections = self.connection_stats["reconnections"]
+        reconnects = reconnections - self.recorded_reconnections
+        self.recorded_reconnections = reconnections
+        relecov_tools.transfer_metrics.get_default_metrics().record(
+            operation, path, n_bytes, seconds, reconnects=reconnects
+        )
+        return
+
+    def read_remote_blocks(self, remote_fh, offset, file_size):
+        """Yield the content of an open remote file from offset, block by block.
+        Without bandwidth limit the rest of the file is prefetched at once. With
+        it, each block is requested as pipelined reads once the limiter allows it,
+        as prefetched data would be received at full speed anyway.
+        """
+        if self.bandwidth_limiter is None:
+            remote_fh.prefetch(file_size)
+            while True:
+                block = remote_fh.read(STREAM_BLOCK_SIZE)
+                if not block:
+                    return
+                yield block
+        while offset < file_size:
+            size = min(STREAM_BLOCK_SIZE, file_size - offset)
+            self.bandwidth_limiter.consume(size)
+            start = offset
+            for block in remote_fh.readv([(offset, size)]):
+                offset += len(block)
+                yield block
+            if offset == start:
+                # Remote file is shorter than expected
+                return
+
+    def is_complete_locally(self, file, destination):
+        """Check if a local file exists and has the same size as the remote one
+
+        Args:
+            file (str): path of the file in remote sftp
+            destination (str): local path of the file after download
+
+        Returns:
+            bool: True if local file exists and matches remote file size
+        """
+        if not os.path.exists(destination):
+            return False
+        local_size = os.path.getsize(destination)
+        if local_size == self.sftp.stat(file).st_size:
+            return True
+        log.warning("Local %s does not match remote size. Downloading", destination)
+        return False
+
+    @reconnect_if_fail(n_times=3, sleep_time=5)
+    def stream_from_sftp(self, file, destination, exist_ok=False):
+        """Download a file from remote sftp computing its md5 hash on the fly
+
+        Args:
+            file (str): path of the file in remote sftp
+            destination (str): local path of the file after download
+            exist_ok (bool): Skip download if file exists in local destination
+
+        Returns:
+            stream_info (dict): Same as stream_file(). False if download failed
+        """
+        try:
+            if exist_ok and self.is_complete_locally(file, destination):
+                stream_info = {
+                    "md5": relecov_tools.utils.calculate_md5(destination),
+                    "gzip_integrity": None,
+                    "size": os.path.getsize(destination),
+                }
+                return stream_info
+            return self.stream_file(file, destination)
+        except FileNotFoundError as e:
+            log.error("Unable to fetch file %s ", e)
+            return False
+
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def get_from_sftp(self, file, destination, exist_ok=False):
         """Download a file from remote sftp
 
@@ -185,17 +543,16 @@ class SftpRelecov:
         Returns:
             bool: True if download was successful, False if it was not
         """
-        if os.path.exists(destination) and exist_ok:
-            return True
-        else:
-            try:
-                self.sftp.get(file, destination)
+        try:
+            if exist_ok and self.is_complete_locally(file, destination):
                 return True
-            except FileNotFoundError as e:
-                log.error("Unable to fetch file %s ", e)
-                return False
+            self.stream_file(file, destination)
+            return True
+        except FileNotFoundError as e:
+            log.error("Unable to fetch file %s ", e)
+            return False
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def make_dir(self, folder_name):
         """Create a new directory in remote sftp
 
@@ -213,7 +570,7 @@ class SftpRelecov:
             stderr.print("[red]Directory already exists")
             return False
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def rename_file(self, old_name, new_name):
         """Rename a file in remote sftp
 
@@ -233,7 +590,7 @@ class SftpRelecov:
             stderr.print(f"[red]{error_txt}")
             return False
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def remove_file(self, file_name):
         """Remove a file from remote sftp
 
@@ -251,7 +608,7 @@ class SftpRelecov:
             stderr.print("[red]File not found")
             return False
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def remove_dir(self, folder_name):
         """Remove a directory from remote sftp
 
@@ -269,7 +626,7 @@ class SftpRelecov:
             stderr.print("[red]Directory not found")
             return False
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def upload_file(self, local_path, remote_file):
         """Upload a file to remote sftp
 
@@ -281,14 +638,45 @@ class SftpRelecov:
             bool: True if file was uploaded, False if it was not
         """
         try:
+            start = time.perf_counter()
             self.sftp.put(local_path, remote_file)
+            self.record_transfer(
+                "upload",
+                local_path,
+                os.path.getsize(local_path),
+                time.perf_counter() - start,
+            )
             return True
         except FileNotFoundError as e:
             log.error("File not found %s", e)
             stderr.print("[red]File not found")
             return False
 
-    @reconnect_if_fail(n_times=3, sleep_time=30)
+    def run_concurrently(self, operation, arguments, max_requests=None):
+        """Send many sftp requests of the same kind, e.g. "rename" or "remove".
+        paramiko waits for each reply, so requests are sent one after another.
+        Backends able to pipeline requests override this method.
+
+        Args:
+            operation (str): sftp client method to call for each request
+            arguments (list(tuple)): arguments for each request
+            max_requests (int, optional): Not used by this backend
+
+        Returns:
+            results (list): result of each request in the same order as the
+            arguments. Failed requests return their exception instead.
+        """
+        self.ensure_connection()
+        method = getattr(self.sftp, operation)
+        results = []
+        for args in arguments:
+            try:
+                results.append(method(*args))
+            except (OSError, paramiko.SSHException) as e:
+                results.append(e)
+        return results
+
+    @reconnect_if_fail(n_times=3, sleep_time=5)
     def close_connection(self):
         log.info("Closing SFTP connection")
         try:
@@ -298,3 +686,281 @@ class SftpRelecov:
             return False
         log.info("SFTP connection closed")
         return True
+
+
+class SftpSessionPool:
+    """Bounded pool of independent SftpRelecov sessions, each one with its own
+    paramiko transport, so several transfers can run at the same time. Sessions
+    are created lazily from a template session the first time they are needed
+    and are reused by the following tasks until close_all() is called.
+    """
+
+    def __init__(self, template, size=1):
+        self.template = template
+        self.size = max(1, int(size))
+        self.idle_sessions = queue.Queue()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take an idle session from the pool, opening a new one if the pool has
+        not reached its size yet. Otherwise wait until a session is released.
+
+        Returns:
+            session (SftpRelecov): connected sftp session
+        """
+        try:
+            return self.check_session(self.idle_sessions.get_nowait())
+        except queue.Empty:
+            pass
+        with self.lock:
+            create_new = len(self.sessions) < self.size
+            if create_new:
+                session = self.template.new_session()
+                self.sessions.append(session)
+        if not create_new:
+            return self.check_session(self.idle_sessions.get())
+        try:
+            session.open_connection()
+        except (paramiko.SSHException, OSError) as e:
+            with self.lock:
+                self.sessions.remove(session)
+            log.error("Could not open new pooled sftp session: %s", e)
+            raise
+        return session
+
+    def check_session(self, session):
+        """Reconnect an idle session if its connection was lost while waiting"""
+        if not session.ensure_connection():
+            log.warning("Pooled sftp session could not reconnect, retrying later")
+        return session
+
+    def get_connection_stats(self):
+        """Return the connection stats of every session in the pool, summed up"""
+        pool_stats = {}
+        with self.lock:
+            for session in self.sessions:
+                if session is self.template:
+                    # Backends sharing a single connection for every session
+                    continue
+                for key, value in session.connection_stats.items():
+                    pool_stats[key] = pool_stats.get(key, 0) + value
+        return pool_stats
+
+    def release(self, session):
+        """Give back a session to the pool once the task using it is finished"""
+        self.idle_sessions.put(session)
+        return
+
+    @contextmanager
+    def session(self):
+        """Context manager to acquire a session and release it afterwards"""
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def run_batch(self, operation, arguments):
+        """Run many sftp operations of the same kind, e.g. "rename" or "remove",
+        spread over the sessions of the pool so they are sent concurrently.
+        Backends multiplexing a single connection send them all at once.
+
+        Args:
+            operation (str): sftp client method to call for each operation
+            arguments (list(tuple)): arguments for each operation
+
+        Returns:
+            results (list): result of each operation in the same order as the
+            arguments. Failed operations return their exception instead.
+        """
+        if not arguments:
+            return []
+        if self.template.multiplexed or self.size <= 1 or len(arguments) == 1:
+            return self.template.run_concurrently(operation, arguments)
+        chunk_size = -(-len(arguments) // self.size)
+        chunks = [
+            arguments[idx : idx + chunk_size]
+            for idx in range(0, len(arguments), chunk_size)
+        ]
+
+        def run_chunk(chunk):
+            try:
+                with self.session() as session:
+                    return session.run_concurrently(operation, chunk)
+            except (paramiko.SSHException, OSError) as e:
+                return [e] * len(chunk)
+
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            results = list(executor.map(run_chunk, chunks))
+        return [result for chunk_results in results for result in chunk_results]
+
+    def close_all(self):
+        """Close every session opened by the pool"""
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+        self.idle_sessions = queue.Queue()
+        for session in sessions:
+            try:
+                session.close_connection()
+                session.client.close()
+            except (paramiko.SSHException, OSError, AttributeError) as e:
+                log.warning("Could not close pooled sftp session: %s", e)
+        return
+
+
+class RemoteTreeSnapshot:
+    """In-memory copy of the remote sftp tree (names, sizes, modes and mtimes)
+    obtained with a single walk, so the same folders are not listed again and
+    again during a run. Changes made by this process (rename, move, delete,
+    upload) must be applied with move(), discard() or invalidate(). Folders
+    that are not in the snapshot are listed on demand.
+    """
+
+    def __init__(self, sftp_relecov, root="."):
+        self.sftp_relecov = sftp_relecov
+        self.root = root
+        self.tree = None
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _key(path):
+        return posixpath.normpath(path)
+
+    def refresh(self):
+        """Walk the whole remote tree again from root, discarding previous data"""
+        walked_tree = self.sftp_relecov.walk_remote_tree(self.root)
+        with self.lock:
+            self.tree = {
+                self._key(folder): {attr.filename: attr for attr in attr_list}
+                for folder, attr_list in walked_tree.items()
+            }
+        return
+
+    def _get_folder(self, folder_name):
+        """Return {name: attributes} for the items in a folder, listing it from
+        the remote server if it is not part of the snapshot"""
+        with self.lock:
+            if self.tree is None:
+                self.refresh()
+            key = self._key(folder_name)
+            if key not in self.tree:
+                attr_list = self.sftp_relecov.get_dir_attributes(folder_name)
+                self.tree[key] = {attr.filename: attr for attr in attr_list}
+            return self.tree[key]
+
+    def get_file_list(self, folder_name):
+        """Same as SftpRelecov.get_file_list, using the snapshot"""
+        return [
+            os.path.join(folder_name, name)
+            for name, attr in self._get_folder(folder_name).items()
+            if stat.S_ISREG(attr.st_mode)
+        ]
+
+    def get_file_sizes(self, folder_name):
+        """Same as SftpRelecov.get_file_sizes, using the snapshot"""
+        return {
+            name: attr.st_size
+            for name, attr in self._get_folder(folder_name).items()
+            if stat.S_ISREG(attr.st_mode)
+        }
+
+    def get_file_attributes(self, folder_name):
+        """Return {file basename: paramiko.SFTPAttributes} for the regular files
+        in the given remote folder"""
+        return {
+            name: attr
+            for name, attr in self._get_folder(folder_name).items()
+            if stat.S_ISREG(attr.st_mode)
+        }
+
+    def get_subfolders(self, folder_name):
+        """Return the names of the folders within the given remote folder"""
+        return [
+            name
+            for name, attr in self._get_folder(folder_name).items()
+            if stat.S_ISDIR(attr.st_mode)
+        ]
+
+    def list_remote_folders(self, folder_name, recursive=False):
+        """Same as SftpRelecov.list_remote_folders, using the snapshot"""
+        subfolders = self.get_subfolders(folder_name)
+        if not subfolders:
+            return [folder_name]
+        if not recursive:
+            return subfolders
+        directory_list = []
+
+        def recursive_list(folder_name):
+            for name in self.get_subfolders(folder_name):
+                abspath = os.path.join(folder_name, name)
+                directory_list.append(abspath)
+                recursive_list(abspath)
+
+        recursive_list(folder_name)
+        if folder_name != ".":
+            directory_list.append(folder_name)
+        return directory_list
+
+    def discard(self, path):
+        """Remove a deleted file or folder (and all its content) from the snapshot"""
+        key = self._key(path)
+        with self.lock:
+            if self.tree is None:
+                return
+            parent = self.tree.get(posixpath.dirname(key) or ".")
+            if parent is not None:
+                parent.pop(posixpath.basename(key), None)
+            for folder in [f for f in self.tree if f == key or f.startswith(key + "/")]:
+                del self.tree[folder]
+        return
+
+    def move(self, old_path, new_path):
+        """Apply a rename of a remote file or folder to the snapshot"""
+        old_key, new_key = self._key(old_path), self._key(new_path)
+        with self.lock:
+            if self.tree is None:
+                return
+            old_parent = self.tree.get(posixpath.dirname(old_key) or ".", {})
+            attr = old_parent.pop(posixpath.basename(old_key), None)
+            new_parent = self.tree.get(posixpath.dirname(new_key) or ".")
+            if attr is None or new_parent is None:
+                # Not enough information to move it locally, list it again later
+                self.invalidate(posixpath.dirname(new_key) or ".")
+            else:
+                attr.filename = posixpath.basename(new_key)
+                new_parent[attr.filename] = attr
+            for folder in [
+                f for f in self.tree if f == old_key or f.startswith(old_key + "/")
+            ]:
+                self.tree[new_key + folder[len(old_key) :]] = self.tree.pop(folder)
+        return
+
+    def invalidate(self, folder_name):
+        """Forget the content of a folder so it is listed again when needed"""
+        with self.lock:
+            if self.tree is not None:
+                self.tree.pop(self._key(folder_name), None)
+        return
+
+
+def create_sftp_client(conf_file=None, username=None, password=None):
+    """Create the sftp client for the backend selected in sftp_handle configuration
+    ("sftp_backend": "paramiko" or "asyncssh"). paramiko is used by default and
+    also when asyncssh is not installed.
+
+    Returns:
+        sftp_client (SftpRelecov): client instance for the selected backend
+    """
+    backend = ConfigJson().get_topic_data("sftp_handle", "sftp_backend") or "paramiko"
+    if backend == "asyncssh":
+        import relecov_tools.async_sftp_client
+
+        if relecov_tools.async_sftp_client.asyncssh is not None:
+            return relecov_tools.async_sftp_client.AsyncSftpRelecov(
+                conf_file, username, password
+            )
+        log.warning("asyncssh is not installed. Using paramiko sftp backend")
+    elif backend != "paramiko":
+        log.warning("Unknown sftp_backend %s. Using paramiko", backend)
+    return SftpRelecov(conf_file, username, password)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SyncManifest:
+    """Persistent record of every file fetched from the remote sftp, stored as a
+    json file. Files are moved between *_tmp_processing folders in remote, so
+    each entry is keyed by the lab folder (first level) and the filename, and
+    keeps the last remote path, size, mtime and md5 of the file. A file whose
+    size or mtime differ from the recorded ones is considered changed.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path, "r") as fh:
+                    self.entries = json.load(fh)
+            except (OSError, ValueError) as e:
+                log.warning("Could not read sync manifest %s: %s", manifest_path, e)
+
+    @staticmethod
+    def get_key(remote_path):
+        """Return the manifest key for a remote path: lab_folder/filename"""
+        lab_folder = remote_path.replace("./", "", 1).split("/")[0]
+        return "/".join([lab_folder, os.path.basename(remote_path)])
+
+    def get(self, remote_path):
+        """Return the recorded entry for a remote file. None if not recorded"""
+        with self.lock:
+            return self.entries.get(self.get_key(remote_path))
+
+    def is_unchanged(self, remote_path, size, mtime):
+        """Check if a remote file was already fetched with the same size and mtime
+
+        Args:
+            remote_path (str): path to the file in remote sftp
+            size (int): current size of the remote file
+            mtime (int): current modification time of the remote file
+
+        Returns:
+            bool: True if the file was recorded with the same size and mtime
+        """
+        entry = self.get(remote_path)
+        if entry is None:
+            return False
+        return entry.get("size") == size and entry.get("mtime") == mtime
+
+    def record(self, remote_path, size, mtime, md5, local_path=None):
+        """Record a file successfully fetched from remote sftp
+
+        Args:
+            remote_path (str): path to the file in remote sftp
+            size (int): size of the remote file
+            mtime (int): modification time of the remote file
+            md5 (str): md5 hash of the fetched file
+            local_path (str, optional): path where the file was downloaded
+        """
+        with self.lock:
+            self.entries[self.get_key(remote_path)] = {
+                "remote_path": remote_path,
+                "size": size,
+                "mtime": mtime,
+                "md5": md5,
+                "local_path": local_path,
+                "synced": time.time(),
+            }
+        return
+
+    def save(self):
+        """Write the manifest to disk, replacing the previous one atomically"""
+        tmp_path = self.manifest_path + ".tmp"
+        with self.lock:
+            try:
+                with open(tmp_path, "w") as fh:
+                    json.dump(self.entries, fh, indent=4, sort_keys=True)
+                os.replace(tmp_path, self.manifest_path)
+            except OSError as e:
+                log.error("Could not save sync manifest %s: %s", self.manifest_path, e)
+                return False
+        return True
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class TransferMetrics:
+    """Thread-safe collector of the bytes and seconds spent on each file by every
+    transfer or processing operation, e.g. "download", "upload", "md5", "compress"
+    or "gzip_check", together with the retries and reconnections it needed.
+    Values are accumulated per file and operation, so repeated operations on the
+    same file are summed up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def record(self, operation, path, n_bytes=0, seconds=0.0, retries=0, reconnects=0):
+        """Add the bytes, seconds, retries and reconnections of an operation
+
+        Args:
+            operation (str): name of the operation, e.g. "download"
+            path (str): local path of the file
+            n_bytes (int, optional): bytes transferred or processed
+            seconds (float, optional): time spent on the operation
+            retries (int, optional): number of times the operation was retried
+            reconnects (int, optional): number of sftp reconnections needed
+        """
+        with self.lock:
+            stats = self.files.setdefault(path, {}).setdefault(
+                operation,
+                {"count": 0, "bytes": 0, "seconds": 0.0, "retries": 0, "reconnects": 0},
+            )
+            if n_bytes or seconds:
+                stats["count"] += 1
+            stats["bytes"] += n_bytes
+            stats["seconds"] += seconds
+            stats["retries"] += retries
+            stats["reconnects"] += reconnects
+        return
+
+    @contextmanager
+    def measure(self, operation, path, n_bytes=0):
+        """Context manager recording the time spent on an operation over n_bytes.
+        Nothing is recorded if the operation raises an exception."""
+        start = time.perf_counter()
+        yield
+        self.record(operation, path, n_bytes, time.perf_counter() - start)
+
+    @staticmethod
+    def add_rate(stats):
+        """Include MB/s in a copy of the given stats"""
+        stats = dict(stats)
+        if stats["seconds"] > 0:
+            stats["mb_per_second"] = round(
+                stats["bytes"] / 1048576 / stats["seconds"], 3
+            )
+        else:
+            stats["mb_per_second"] = None
+        stats["seconds"] = round(stats["seconds"], 3)
+        return stats
+
+    def get_files(self, folder=None):
+        """Return {path: {operation: stats}} of all files, or only for the files
+        within the given local folder"""
+        with self.lock:
+            if folder is None:
+                return {path: dict(ops) for path, ops in self.files.items()}
+            prefix = os.path.join(os.path.abspath(folder), "")
+            return {
+                path: dict(ops)
+                for path, ops in self.files.items()
+                if os.path.abspath(path).startswith(prefix)
+            }
+
+    def summarize(self, folder=None):
+        """Sum the stats of every file for each operation
+
+        Args:
+            folder (str, optional): only include files within this local folder
+
+        Returns:
+            summary (dict): {operation: {"count", "bytes", "seconds", "retries",
+            "reconnects", "mb_per_second"}}
+        """
+        return self.sum_operations(self.get_files(folder).values())
+
+    def sum_operations(self, files_operations):
+        """Sum the stats of each operation over a list of {operation: stats}"""
+        totals = {}
+        for operations in files_operations:
+            for operation, stats in operations.items():
+                total = totals.setdefault(operation, dict.fromkeys(stats, 0))
+                for key, value in stats.items():
+                    total[key] += value
+        return {operation: self.add_rate(total) for operation, total in totals.items()}
+
+    def folder_report(self, folder):
+        """Return the metrics of a local folder: totals per operation and the
+        stats of each file, to be included in the folder log summary"""
+        files = {
+            os.path.relpath(path, folder): {
+                operation: self.add_rate(stats) for operation, stats in ops.items()
+            }
+            for path, ops in sorted(self.get_files(folder).items())
+        }
+        return {"operations": self.summarize(folder), "files": files}
+
+    def summarize_by_folder(self):
+        """Return {local folder: summary} for every folder with recorded files,
+        only including the files directly within each folder"""
+        folder_files = {}
+        for path, operations in self.get_files().items():
+            folder_files.setdefault(os.path.dirname(path), []).append(operations)
+        return {
+            folder: self.sum_operations(folder_files[folder])
+            for folder in sorted(folder_files)
+        }
+
+    def write_json(self, file_path):
+        """Write the totals per operation, per folder and per file to a json file"""
+        metrics = {
+            "generated": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "operations": self.summarize(),
+            "folders": self.summarize_by_folder(),
+            "files": {
+                path: {op: self.add_rate(stats) for op, stats in ops.items()}
+                for path, ops in sorted(self.get_files().items())
+            },
+        }
+        with open(file_path, "w") as fh:
+            json.dump(metrics, fh, indent=4)
+        return
+
+    def write_prometheus(self, file_path, root_folder=None):
+        """Write the totals per operation and folder in Prometheus text format, to
+        be exposed by node_exporter textfile collector. The file is replaced
+        atomically so the collector never reads it half written.
+
+        Args:
+            file_path (str): path to the output .prom file
+            root_folder (str, optional): folder labels are relative to this one
+        """
+        metric_help = {
+            "bytes": "Bytes transferred or processed",
+            "seconds": "Seconds spent on the operation",
+            "count": "Number of times the operation was run",
+            "retries": "Number of retries",
+            "reconnects": "Number of sftp reconnections",
+        }
+        folder_summaries = self.summarize_by_folder()
+        lines = []
+        for key, help_text in metric_help.items():
+            metric = "relecov_transfer_%s_total" % key
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s counter" % metric)
+            for folder, summary in folder_summaries.items():
+                if root_folder:
+                    folder = os.path.relpath(folder, root_folder)
+                for operation, stats in sorted(summary.items()):
+                    labels = 'operation="%s",folder="%s"' % (
+                        operation,
+                        folder.replace('"', "'"),
+                    )
+                    lines.append("%s{%s} %s" % (metric, labels, stats[key]))
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, file_path)
+        return
+
+    def log_summary(self):
+        """Log the totals and throughput of each operation"""
+        for operation, stats in sorted(self.summarize().items()):
+            log.info(
+                "%s: %s files, %s bytes in %s seconds (%s MB/s), %s retries, "
+                "%s reconnections"
+                % (
+                    operation,
+                    stats["count"],
+                    stats["bytes"],
+                    stats["seconds"],
+                    stats["mb_per_second"],
+                    stats["retries"],
+                    stats["reconnects"],
+                )
+            )
+        return
+
+
+_default_metrics = TransferMetrics()
+
+
+def get_default_metrics():
+    """Return the metrics collector shared by the whole process"""
+    return _default_metrics
@@ -9,6 +9,7 @@ import rich.console
 import time
 
 import relecov_tools.utils
+import relecov_tools.compiled_schema
 from relecov_tools.config_json import ConfigJson
 from relecov_tools.rest_api import RestApi
 from relecov_tools.log_summary import LogSum
@@ -59,7 +60,8 @@ class UpdateDatabase:
             "schema",
             self.config_json.get_topic_data("json_schemas", "relecov_schema"),
         )
-        self.schema = relecov_tools.utils.read_json_file(schema)
+        self.compiled_schema = relecov_tools.compiled_schema.load_schema(schema)
+        self.schema = self.compiled_schema.schema
         if full_update is True:
             self.full_update = True
             self.server_url = None
@@ -99,11 +101,11 @@ class UpdateDatabase:
 
     def get_schema_ontology_values(self):
         """Read the schema and extract the values of ontology with the label"""
-        ontology_dict = {}
-        for prop, values in self.schema["properties"].items():
-            if "ontology" in values and values["ontology"] != "":
-                ontology_dict[values["ontology"]] = prop
-        return ontology_dict
+        return {
+            ontology: prop
+            for ontology, prop in self.compiled_schema.ontology_to_property.items()
+            if ontology != ""
+        }
 
     def map_iskylims_sample_fields_values(self, sample_fields, s_project_fields):
         """Map the values to the properties send to databasee
@@ -192,7 +192,7 @@ class EnaUpload:
             source_topic = "_".join(["df", source, "fields"])
             source_fields = self.config_json.get_topic_data("ENA_fields", source_topic)
             if self.action in ["CANCEL", "MODIFY", "RELEASE"]:
-                source_fields.append(str("ena_" + source + "_accession"))
+                source_fields = source_fields + [str("ena_" + source + "_accession")]
             source_dict = {
                 field: [
                     sample[field]
@@ -14,16 +14,27 @@ import yaml
 import gzip
 import re
 import shutil
-from itertools import islice
+import bisect
+import struct
+import zlib
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from Bio import SeqIO
 from rich.console import Console
 from datetime import datetime
 from tabulate import tabulate
 import openpyxl.utils
 import openpyxl.styles
+import relecov_tools.hash_cache
+import relecov_tools.transfer_metrics
+import relecov_tools.workbook_cache
 
 
 log = logging.getLogger(__name__)
+# Size of the blocks read from disk when hashing files
+MD5_BLOCK_SIZE = 4194304
 
 
 def file_exists(file_to_check):
@@ -51,6 +62,85 @@ def get_files_match_condition(condition):
     return glob.glob(condition)
 
 
+class FileNameIndex:
+    """Index over a list of file names to find those containing a given text, with
+    the same result as testing `text in file` for every file but without scanning
+    the whole list. Each name is split in overlapping tokens of gram_size chars
+    and only the files sharing every token of the text are checked. Files can also
+    be looked up by name prefix or by name without extension.
+
+    Args:
+        file_names (list(str)): file names or paths to be indexed
+        gram_size (int, optional): length of the tokens. Defaults to 3.
+    """
+
+    def __init__(self, file_names, gram_size=3):
+        self.file_names = list(file_names)
+        self.gram_size = gram_size
+        self.grams = {}
+        self.stems = {}
+        for pos, file_name in enumerate(self.file_names):
+            for idx in range(len(file_name) - gram_size + 1):
+                self.grams.setdefault(file_name[idx : idx + gram_size], set()).add(pos)
+            self.stems.setdefault(self.get_stem(file_name), []).append(pos)
+        self.sorted_names = sorted(
+            (os.path.basename(name), pos) for pos, name in enumerate(self.file_names)
+        )
+
+    @staticmethod
+    def get_stem(file_name):
+        """Return the basename without its extension, e.g. sample.fastq.gz -> sample"""
+        return os.path.basename(file_name).split(".")[0]
+
+    def find_all(self, text):
+        """Return every file name containing text, in the order they were given"""
+        if len(text) < self.gram_size:
+            return [file for file in self.file_names if text in file]
+        postings = []
+        for idx in range(len(text) - self.gram_size + 1):
+            posting = self.grams.get(text[idx : idx + self.gram_size])
+            if not posting:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+        return [
+            self.file_names[pos]
+            for pos in sorted(candidates)
+            if text in self.file_names[pos]
+        ]
+
+    def find_first(self, text, default=None):
+        """Return the first file name containing text"""
+        matches = self.find_all(text)
+        return matches[0] if matches else default
+
+    def find_last(self, text, default=None):
+        """Return the last file name containing text"""
+        matches = self.find_all(text)
+        return matches[-1] if matches else default
+
+    def find_stem(self, file_name):
+        """Return the file names equal to the given one regardless of extensions"""
+        return [
+            self.file_names[pos] for pos in self.stems.get(self.get_stem(file_name), [])
+        ]
+
+    def find_prefix(self, prefix):
+        """Return the file names whose basename starts with prefix"""
+        start = bisect.bisect_left(self.sorted_names, (prefix,))
+        matches = []
+        for name, pos in self.sorted_names[start:]:
+            if not name.startswith(prefix):
+                break
+            matches.append(pos)
+        return [self.file_names[pos] for pos in sorted(matches)]
+
+
 def read_json_file(j_file):
     """Read json file."""
     with open(j_file, "r") as fh:
@@ -62,37 +152,147 @@ def read_json_file(j_file):
     return data
 
 
-def read_excel_file(f_name, sheet_name, header_flag, leave_empty=True):
-    """Read the input excel file and give the information in a list
-    of dictionaries
+class ParsedSheet:
+    """Header and non-empty rows of an excel sheet, as read by ExcelSheetReader,
+    kept in memory so they can be iterated many times and cached
+
+    Args:
+        header (tuple): values in the header row
+        header_row (int): number of the header row in the sheet
+        rows (list(tuple)): (row number, tuple of values) of each non-empty row
     """
-    wb_file = openpyxl.load_workbook(f_name, data_only=True)
-    ws_metadata_lab = wb_file[sheet_name]
-    try:
-        heading_row = [
-            idx + 1 for idx, x in enumerate(ws_metadata_lab.values) if header_flag in x
-        ][0]
-    except IndexError:
-        raise KeyError(f"Header flag '{header_flag}' could not be found in {f_name}")
-    heading = [str(i.value).strip() for i in ws_metadata_lab[heading_row] if i.value]
-    ws_data = []
-    for row in islice(ws_metadata_lab.values, heading_row, ws_metadata_lab.max_row):
-        l_row = list(row)
-        # Ignore the empty rows
-        if all(cell is None for cell in l_row):
-            continue
-        data_row = {}
-        for idx in range(0, len(heading)):
-            if l_row[idx] is None:
-                if leave_empty:
-                    data_row[heading[idx]] = None
-                else:
-                    data_row[heading[idx]] = "Not Provided [GENEPIO:0001668]"
+
+    def __init__(self, header, header_row, rows):
+        self.header = header
+        self.header_row = header_row
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_rows()
+
+    def iter_rows(self):
+        """Yield (row number, tuple of values) for each non-empty row after the
+        header"""
+        return iter(self.rows)
+
+    def iter_dicts(self, heading, empty_value=None):
+        """Yield a dict for each non-empty row after the header, mapping each
+        name in heading to the value in the same position"""
+        for _, row in self.iter_rows():
+            yield {
+                name: empty_value if row[idx] is None else row[idx]
+                for idx, name in enumerate(heading)
+            }
+
+    def close(self):
+        return
+
+
+class ExcelSheetReader(ParsedSheet):
+    """Single pass streaming reader for a sheet of an excel file. The workbook is
+    opened in read-only mode, so rows are parsed lazily and memory usage does not
+    depend on the formatted region of the sheet or on its other sheets.
+
+    The header row is the first one including header_flag. Rows after it are
+    yielded one by one, skipping the empty ones, until max_empty_rows empty rows
+    in a row are found or the sheet ends.
+
+    Raises:
+        KeyError: If the sheet does not exist or header_flag is not found
+    """
+
+    def __init__(self, f_name, sheet_name, header_flag, max_empty_rows=None):
+        self.f_name = f_name
+        self.max_empty_rows = int(max_empty_rows) if max_empty_rows else None
+        self.workbook = openpyxl.load_workbook(f_name, read_only=True, data_only=True)
+        try:
+            self.rows = self.workbook[sheet_name].iter_rows(values_only=True)
+            for idx, row in enumerate(self.rows):
+                if header_flag in row:
+                    self.header = row
+                    self.header_row = idx + 1
+                    break
             else:
-                data_row[heading[idx]] = l_row[idx]
-        ws_data.append(data_row)
+                raise KeyError(
+                    f"Header flag '{header_flag}' could not be found in {f_name}"
+                )
+        except KeyError:
+            self.close()
+            raise
+
+    def iter_rows(self):
+        """Yield (row number, tuple of values) for each non-empty row after the
+        header. Rows shorter than the header are filled with None"""
+        empty_rows = 0
+        row_number = self.header_row
+        for row in self.rows:
+            row_number += 1
+            if all(cell is None for cell in row):
+                empty_rows += 1
+                if self.max_empty_rows and empty_rows >= self.max_empty_rows:
+                    break
+                continue
+            empty_rows = 0
+            if len(row) < len(self.header):
+                row = row + (None,) * (len(self.header) - len(row))
+            yield row_number, row
+        self.close()
+
+    def close(self):
+        self.workbook.close()
+        return
+
+
+def read_excel_sheet(f_name, sheet_name, header_flag, max_empty_rows=None):
+    """Read the header and rows of an excel sheet with ExcelSheetReader, reusing
+    the result if the same file content was already parsed with the same args
+
+    Args:
+        f_name (str): path to the excel file
+        sheet_name (str): name of the sheet to read
+        header_flag (str): value included in the header row
+        max_empty_rows (int, optional): stop after this number of empty rows
 
-    return ws_data, heading_row
+    Raises:
+        KeyError: If the sheet does not exist or header_flag is not found
+
+    Returns:
+        parsed_sheet (ParsedSheet): header and non-empty rows of the sheet
+    """
+    workbook_cache = relecov_tools.workbook_cache.get_default_cache()
+    if workbook_cache is not None:
+        cache_key = workbook_cache.make_key(
+            calculate_md5(f_name), "sheet", sheet_name, header_flag, max_empty_rows
+        )
+        parsed_sheet = workbook_cache.get(cache_key)
+        if parsed_sheet is not None:
+            return parsed_sheet
+    with ExcelSheetReader(f_name, sheet_name, header_flag, max_empty_rows) as reader:
+        parsed_sheet = ParsedSheet(
+            reader.header, reader.header_row, list(reader.iter_rows())
+        )
+    if workbook_cache is not None:
+        workbook_cache.put(cache_key, parsed_sheet)
+    return parsed_sheet
+
+
+def read_excel_file(
+    f_name, sheet_name, header_flag, leave_empty=True, max_empty_rows=None
+):
+    """Read the input excel file and give the information in a list
+    of dictionaries
+    """
+    parsed_sheet = read_excel_sheet(f_name, sheet_name, header_flag, max_empty_rows)
+    heading = [str(i).strip() for i in parsed_sheet.header if i]
+    empty_value = None if leave_empty else "Not Provided [GENEPIO:0001668]"
+    ws_data = list(parsed_sheet.iter_dicts(heading, empty_value))
+    return ws_data, parsed_sheet.header_row
 
 
 def excel_date_to_num(date):
@@ -221,9 +421,80 @@ def delete_local_folder(folder):
     return True
 
 
-def calculate_md5(file_name):
-    """Calculate the md5 value for the file name"""
-    return hashlib.md5(open(file_name, "rb").read()).hexdigest()
+def format_size(n_bytes):
+    """Return a human readable size, e.g. 1.50 GB"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n_bytes) < 1024:
+            return "%.2f %s" % (n_bytes, unit)
+        n_bytes /= 1024
+    return "%.2f TB" % n_bytes
+
+
+def calculate_md5(file_name, block_size=MD5_BLOCK_SIZE, use_cache=True):
+    """Calculate the md5 value for the file name, reading it in fixed-size blocks
+    so memory usage does not depend on file size. The persistent hash cache is
+    checked first and updated afterwards unless use_cache is False.
+    """
+    hash_cache = relecov_tools.hash_cache.get_default_cache() if use_cache else None
+    file_stat = os.stat(file_name)
+    if hash_cache is not None:
+        cached_md5 = hash_cache.get(file_name, file_stat)
+        if cached_md5:
+            return cached_md5
+    md5_hash = hashlib.md5()
+    metrics = relecov_tools.transfer_metrics.get_default_metrics()
+    with metrics.measure("md5", file_name, file_stat.st_size):
+        with open(file_name, "rb") as fh:
+            for block in iter(lambda: fh.read(block_size), b""):
+                md5_hash.update(block)
+    md5 = md5_hash.hexdigest()
+    if hash_cache is not None:
+        hash_cache.put(file_name, md5, file_stat)
+    return md5
+
+
+def calculate_md5_batch(
+    file_list, max_workers=None, block_size=MD5_BLOCK_SIZE, progress_callback=None
+):
+    """Calculate the md5 value for many files concurrently. Each file is read in
+    fixed-size blocks, so memory usage is bounded by max_workers * block_size.
+    hashlib releases the GIL while hashing, so threads use multiple cores.
+
+    Args:
+        file_list (list(str)): paths to the files to be hashed
+        max_workers (int, optional): number of files hashed at the same time.
+        Defaults to the number of CPUs.
+        block_size (int, optional): bytes read from disk each time
+        progress_callback (callable, optional): called as (files done, total
+        files, path) every time a file is finished
+
+    Returns:
+        md5_dict (dict(str:str)): {path: md5 hash}. Files that could not be read
+        are logged and not included.
+    """
+
+    def safe_md5(file_name):
+        try:
+            return calculate_md5(file_name, block_size)
+        except OSError as e:
+            log.error("Could not calculate md5 for %s: %s", file_name, e)
+            return None
+
+    unique_files = list(dict.fromkeys(file_list))
+    if not unique_files:
+        return {}
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(int(max_workers), len(unique_files)))
+    hashes = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(safe_md5, path): path for path in unique_files}
+        for done, future in enumerate(as_completed(futures), start=1):
+            hashes[futures[future]] = future.result()
+            if progress_callback is not None:
+                progress_callback(done, len(unique_files), futures[future])
+    md5_dict = {path: hashes[path] for path in unique_files if hashes[path] is not None}
+    return md5_dict
 
 
 def write_md5_file(file_name, md5_value):
@@ -262,23 +533,141 @@ def write_json_fo_file(data, file_name):
     return True
 
 
-def compress_file(file):
-    """compress a given file with gzip, adding .gz extension afterwards
+def compress_block(block, level=9):
+    """Compress a block of data as an independent gzip member, checking that its
+    CRC32 and ISIZE trailer match the ones of the original block. The member is
+    not decompressed again, as that would double the cost of compression.
+
+    Args:
+        block (bytes): uncompressed data
+        level (int, optional): gzip compression level. Defaults to 9
+
+    Returns:
+        member (bytes): compressed gzip member
+        valid (bool): True if the member trailer matches the original data
+    """
+    member = gzip.compress(block, compresslevel=level, mtime=0)
+    crc, isize = struct.unpack("<II", member[-8:])
+    valid = crc == zlib.crc32(block) and isize == len(block) & 0xFFFFFFFF
+    return member, valid
+
+
+def compress_file(file, level=9, block_size=16777216, executor=None, max_pending=2):
+    """compress a given file with gzip, adding .gz extension afterwards. The file
+    is split in blocks of block_size bytes, each of them compressed as an
+    independent gzip member, so the output is a standard multi-member gzip file.
+    If a process pool executor is given, blocks are compressed in parallel.
+    The md5 of the compressed file and the integrity of every member are obtained
+    in the same pass, so the output does not need to be read again.
 
     Args:
         file (str): path to the given file
+        level (int, optional): gzip compression level. Defaults to 9
+        block_size (int, optional): size in bytes of each compressed block
+        executor (concurrent.futures.Executor, optional): pool used to compress
+        the blocks. Blocks are compressed sequentially if not given.
+        max_pending (int, optional): blocks submitted to the executor and kept in
+        memory at the same time, e.g. twice its workers. Defaults to 2
+
+    Returns:
+        compress info (dict): {"md5": hash, "gzip_integrity": bool, "size": int}
+        of the compressed file. False if the file was not found
     """
+    md5_hash = hashlib.md5()
+    gzip_integrity = True
+    size = 0
+    start = time.perf_counter()
     try:
-        with open(file, "rb") as raw, gzip.open(f"{file}.gz", "wb") as comp:
-            comp.writelines(raw)
-        return True
+        with open(file, "rb") as raw, open(f"{file}.gz", "wb") as comp:
+
+            def write_member(member, valid):
+                nonlocal gzip_integrity, size
+                comp.write(member)
+                md5_hash.update(member)
+                size += len(member)
+                gzip_integrity = gzip_integrity and valid
+
+            if executor is None:
+                for block in iter(lambda: raw.read(block_size), b""):
+                    write_member(*compress_block(block, level))
+            else:
+                max_pending = max(1, max_pending)
+                pending = deque()
+                for block in iter(lambda: raw.read(block_size), b""):
+                    pending.append(executor.submit(compress_block, block, level))
+                    if len(pending) >= max_pending:
+                        write_member(*pending.popleft().result())
+                while pending:
+                    write_member(*pending.popleft().result())
+            if size == 0:
+                # Empty input still produces a valid empty gzip file
+                write_member(*compress_block(b"", level))
     except FileNotFoundError:
         return False
+    relecov_tools.transfer_metrics.get_default_metrics().record(
+        "compress", file, os.path.getsize(file), time.perf_counter() - start
+    )
+    md5 = md5_hash.hexdigest()
+    hash_cache = relecov_tools.hash_cache.get_default_cache()
+    if hash_cache is not None and gzip_integrity:
+        hash_cache.put(f"{file}.gz", md5)
+    return {"md5": md5, "gzip_integrity": gzip_integrity, "size": size}
+
+
+def create_compression_pool(workers):
+    """Return a pool of worker processes to compress file blocks. Processes are
+    only started when the first block is submitted"""
+    # spawn avoids forking the threads of open sftp connections
+    mp_context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+
+
+def compress_files(
+    file_list, workers=None, level=9, block_size=16777216, executor=None
+):
+    """Compress many files at the same time, sharing a single pool of worker
+    processes that compress the blocks of every file in parallel
+
+    Args:
+        file_list (list(str)): paths to the files to be compressed
+        workers (int, optional): number of worker processes. Defaults to CPUs
+        level (int, optional): gzip compression level. Defaults to 9
+        block_size (int, optional): size in bytes of each compressed block
+        executor (concurrent.futures.Executor, optional): pool from
+        create_compression_pool() with the given number of workers, shared with
+        other calls. A new pool is created for this call if not given
+
+    Returns:
+        compressed (dict(str:dict)): {path: compress info as returned by
+        compress_file, False if not found}
+    """
+    if not file_list:
+        return {}
+    if not workers:
+        workers = os.cpu_count() or 1
+    total_size = sum(os.path.getsize(f) for f in file_list if os.path.isfile(f))
+    if workers <= 1 or total_size <= block_size:
+        return {f: compress_file(f, level, block_size) for f in file_list}
+    if executor is None:
+        with create_compression_pool(workers) as pool:
+            return compress_files(file_list, workers, level, block_size, pool)
+    # Limit the blocks in memory of each file to twice the number of workers
+    max_pending = 2 * workers
+    with ThreadPoolExecutor(max_workers=min(workers, len(file_list))) as files_pool:
+        results = files_pool.map(
+            lambda f: compress_file(
+                f, level, block_size, executor=executor, max_pending=max_pending
+            ),
+            file_list,
+        )
+        compressed = dict(zip(file_list, results))
+    return compressed
 
 
 def check_gzip_integrity(file_path):
     """Check if a compressed file is not corrupted"""
     chunksize = 100000000  # 10 Mbytes
+    start = time.perf_counter()
     with gzip.open(file_path, "rb") as f:
         try:
             while f.read(chunksize) != b"":
@@ -289,9 +678,51 @@ def check_gzip_integrity(file_path):
         # EOFError: Compressed file is truncated
         except EOFError:
             return False
+    relecov_tools.transfer_metrics.get_default_metrics().record(
+        "gzip_check", file_path, os.path.getsize(file_path), time.perf_counter() - start
+    )
     return True
 
 
+class GzipIntegrityChecker:
+    """Check the integrity of a gzip file while it is being read or written, feeding
+    it block by block. Multi-member gzip files are supported. Decompressed data is
+    discarded, so memory usage is bounded by the decompression buffer size.
+    """
+
+    def __init__(self, buffer_size=1048576):
+        self.buffer_size = buffer_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.member_started = False
+        self.corrupted = False
+
+    def update(self, data):
+        """Feed the next block of compressed data to the checker"""
+        if self.corrupted:
+            return
+        try:
+            while data:
+                if not self.member_started:
+                    # Zero padding after the last member is accepted by gzip
+                    if not data.strip(b"\x00"):
+                        return
+                    self.member_started = True
+                self.decompressor.decompress(data, self.buffer_size)
+                if self.decompressor.eof:
+                    data = self.decompressor.unused_data
+                    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    self.member_started = False
+                else:
+                    data = self.decompressor.unconsumed_tail
+        except zlib.error:
+            self.corrupted = True
+        return
+
+    def is_valid(self):
+        """Return True if all data fed so far forms complete, non-corrupted members"""
+        return not self.corrupted and not self.member_started
+
+
 def rich_force_colors():
     """
     Check if any environment variables are set to force Rich to use coloured output
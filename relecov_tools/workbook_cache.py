@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import zlib
+from collections import OrderedDict
+from relecov_tools.config_json import ConfigJson
+
+log = logging.getLogger(__name__)
+
+
+class WorkbookCache:
+    """Cache of parsed excel workbooks, so the same metadata file is only parsed
+    once even if it is read by several modules. Entries are keyed by the md5 of
+    the file content and the parsing arguments, and stored as compressed pickles.
+    The least recently used entries are evicted once max_memory_mb is reached,
+    being written to spill_folder first if one is given. Each get() returns a
+    new copy of the cached object, so callers may modify it.
+    """
+
+    def __init__(self, max_memory_mb=64, spill_folder=None):
+        self.max_bytes = int(float(max_memory_mb) * 1048576)
+        self.spill_folder = spill_folder or None
+        if self.spill_folder:
+            os.makedirs(self.spill_folder, exist_ok=True)
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(content_md5, *parse_args):
+        """Return the cache key for a file content and its parsing arguments"""
+        return hashlib.md5(repr((content_md5,) + parse_args).encode()).hexdigest()
+
+    def get_spill_path(self, key):
+        return os.path.join(self.spill_folder, key + ".pickle.gz")
+
+    def get(self, key):
+        """Return a copy of the cached object for the given key. None if missing"""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+        if data is None and self.spill_folder:
+            try:
+                with open(self.get_spill_path(key), "rb") as fh:
+                    data = fh.read()
+            except OSError:
+                return None
+            self.store(key, data)
+        if data is None:
+            return None
+        try:
+            return pickle.loads(zlib.decompress(data))
+        except (pickle.UnpicklingError, zlib.error, EOFError, AttributeError) as e:
+            log.warning("Discarded invalid workbook cache entry %s: %s", key, e)
+            self.discard(key)
+            return None
+
+    def put(self, key, value):
+        """Store a parsed object in cache"""
+        data = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        if len(data) > self.max_bytes:
+            # Too large to be kept in memory
+            self.spill(key, data)
+            return
+        self.store(key, data)
+        return
+
+    def store(self, key, data):
+        """Keep compressed data in memory, evicting the least recently used"""
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.used_bytes -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.used_bytes += len(data)
+            while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, old_data = self.entries.popitem(last=False)
+                self.used_bytes -= len(old_data)
+                evicted.append((old_key, old_data))
+        for old_key, old_data in evicted:
+            self.spill(old_key, old_data)
+        return
+
+    def spill(self, key, data):
+        """Write an entry to spill_folder, if any, to be loaded again later"""
+        if not self.spill_folder:
+            return
+        spill_path = self.get_spill_path(key)
+        if os.path.exists(spill_path):
+            return
+        tmp_path = spill_path + ".%s.tmp" % threading.get_ident()
+        try:
+            with open(tmp_path, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp_path, spill_path)
+        except OSError as e:
+            log.warning("Could not spill workbook cache entry to %s: %s", spill_path, e)
+        return
+
+    def discard(self, key):
+        """Remove an entry from memory and from spill_folder"""
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.used_bytes -= len(data)
+        if self.spill_folder and os.path.exists(self.get_spill_path(key)):
+            try:
+                os.remove(self.get_spill_path(key))
+            except OSError:
+                pass
+        return
+
+
+_default_cache = None
+_default_cache_configured = False
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """Return the workbook cache shared by every module, created the first time
+    following workbook_cache in configuration.json. None if it is disabled"""
+    global _default_cache, _default_cache_configured
+    with _default_cache_lock:
+        if _default_cache_configured:
+            return _default_cache
+        _default_cache_configured = True
+        cache_config = ConfigJson().get_configuration("workbook_cache") or {}
+        if str(cache_config.get("enabled", "True")) != "True":
+            return None
+        try:
+            _default_cache = WorkbookCache(
+                max_memory_mb=cache_config.get("max_memory_mb", 64),
+                spill_folder=cache_config.get("spill_folder"),
+            )
+        except OSError as e:
+            log.warning("Could not create workbook cache: %s", e)
+            _default_cache = None
+    return _default_cache
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import hashlib
+import argparse
+import resource
+import subprocess
+import tempfile
+import relecov_tools.utils
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare throughput and peak RSS of md5 hashing implementations"
+    )
+    parser.add_argument("-n", "--num_files", type=int, default=8, help="Files")
+    parser.add_argument("-s", "--size_mb", type=int, default=256, help="MB per file")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Workers")
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--files", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.files, args.workers)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"Creating {args.num_files} files of {args.size_mb} MB in {tmp_dir}")
+        file_list = create_test_files(tmp_dir, args.num_files, args.size_mb)
+        total_mb = args.num_files * args.size_mb
+        results = {}
+        for mode in ("full_read", "chunked", "batch"):
+            # Each mode runs in its own process so peak RSS is not shared
+            cmd = [sys.executable, __file__, "--mode", mode, "--files", *file_list]
+            if args.workers:
+                cmd.extend(["--workers", str(args.workers)])
+            out = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            seconds, peak_rss_kb, digest = out.stdout.split()
+            results[mode] = (float(seconds), int(peak_rss_kb), digest)
+        print(f"{'mode':<10} {'seconds':>9} {'MB/s':>9} {'peak RSS MB':>12}")
+        for mode, (seconds, peak_rss_kb, _) in results.items():
+            throughput = total_mb / seconds if seconds else float("inf")
+            print(
+                f"{mode:<10} {seconds:>9.2f} {throughput:>9.1f} {peak_rss_kb/1024:>12.1f}"
+            )
+        if len({res[2] for res in results.values()}) != 1:
+            print("ERROR: md5 results differ between implementations")
+            sys.exit(1)
+
+
+def create_test_files(folder, num_files, size_mb):
+    file_list = []
+    block = os.urandom(1024 * 1024)
+    for idx in range(num_files):
+        path = os.path.join(folder, f"SAMPLE{idx}_R1.fastq.gz")
+        with open(path, "wb") as fh:
+            for _ in range(size_mb):
+                fh.write(block)
+        file_list.append(path)
+    return file_list
+
+
+def run_mode(mode, file_list, workers):
+    start = time.perf_counter()
+    if mode == "full_read":
+        # Previous implementation, loading the whole file in memory
+        md5_dict = {f: hashlib.md5(open(f, "rb").read()).hexdigest() for f in file_list}
+    elif mode == "chunked":
+        md5_dict = {f: relecov_tools.utils.calculate_md5(f) for f in file_list}
+    else:
+        md5_dict = relecov_tools.utils.calculate_md5_batch(file_list, workers)
+    seconds = time.perf_counter() - start
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    digest = hashlib.md5("".join(md5_dict[f] for f in file_list).encode()).hexdigest()
+    print(f"{seconds} {peak_rss_kb} {digest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import os
+import sys
+import copy
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+from jsonschema import Draft202012Validator
+from relecov_tools.json_validation import SchemaValidation
+
+DATA_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    "data",
+    "map_validate",
+    "processed_metadata_lab_test.json",
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the time spent validating samples against the schema"
+    )
+    parser.add_argument("-n", "--num_samples", type=int, default=20000, help="Samples")
+    parser.add_argument(
+        "-i", "--invalid_ratio", type=float, default=0.3, help="Ratio of invalid"
+    )
+    args = parser.parse_args()
+    # Errors are summarized in the log summary, do not print every one of them
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_file = os.path.join(tmp_dir, "lab", "out", "samples.json")
+        os.makedirs(os.path.dirname(json_file))
+        samples = create_samples(args.num_samples, args.invalid_ratio)
+        with open(json_file, "w") as fh:
+            json.dump(samples, fh)
+        validation = SchemaValidation(json_file, out_folder=tmp_dir)
+        print(f"Validating {len(samples)} samples")
+        start = time.perf_counter()
+        previous = previous_validate_instances(validation)
+        previous_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        valid_json_data, invalid_json = validation.validate_instances()
+        seconds = time.perf_counter() - start
+    print(f"{'implementation':<15} {'seconds':>9} {'samples/s':>10}")
+    for name, secs in (("previous", previous_seconds), ("single pass", seconds)):
+        print(f"{name:<15} {secs:>9.2f} {len(samples) / secs:>10.0f}")
+    if previous != (len(valid_json_data), len(invalid_json)):
+        print("ERROR: valid and invalid samples differ between implementations")
+        sys.exit(1)
+
+
+def create_samples(num_samples, invalid_ratio):
+    """Copy the test samples, breaking a required field, an enum or a date in a
+    part of them"""
+    with open(DATA_FILE) as fh:
+        base_samples = json.load(fh)
+    random.seed(1)
+    samples = []
+    for idx in range(num_samples):
+        sample = copy.deepcopy(base_samples[idx % len(base_samples)])
+        sample["sequencing_sample_id"] = f"SAMPLE{idx}"
+        if random.random() < invalid_ratio:
+            broken_field = random.choice(
+                ["collecting_institution", "library_layout", "sample_collection_date"]
+            )
+            if broken_field == "collecting_institution":
+                sample.pop(broken_field, None)
+            elif broken_field == "library_layout":
+                sample[broken_field] = "Unknown layout"
+            else:
+                sample[broken_field] = "2022/31/31"
+        samples.append(sample)
+    return samples
+
+
+def previous_validate_instances(validation):
+    """Previous implementation: invalid samples were validated twice and the
+    field of each error searched in the schema"""
+    validator = Draft202012Validator(validation.json_schema)
+    schema_props = validation.json_schema["properties"]
+    valid, invalid = 0, 0
+    errors = {}
+    for item_row in validation.json_data:
+        if validator.is_valid(item_row):
+            valid += 1
+            continue
+        for error in validator.iter_errors(item_row):
+            if error.validator == "required":
+                fields = error.validator_value
+                error_field = [f for f in fields if f in error.message][0]
+            else:
+                error_field = error.absolute_path[0]
+            try:
+                err_field_label = schema_props[error_field]["label"]
+            except KeyError:
+                err_field_label = error_field
+            error_text = f"Error in column {err_field_label}: {error.message}"
+            errors[error_text] = errors.get(error_text, 0) + 1
+        invalid += 1
+    return valid, invalid
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import asyncio
+import threading
+import pytest
+
+
+class LocalSftpServer:
+    """SFTP server stand-in listening on localhost, serving a local folder. It
+    runs its own event loop in a background thread and accepts any password.
+
+    Attributes:
+        root (str): local folder seen by clients as the sftp root
+        port (int): port where the server is listening
+    """
+
+    def __init__(self, asyncssh, root):
+        self.root = str(root)
+        self.connections = []
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        server = self
+
+        class PasswordServer(asyncssh.SSHServer):
+            def connection_made(self, conn):
+                server.connections.append(conn)
+
+            def begin_auth(self, username):
+                return True
+
+            def password_auth_supported(self):
+                return True
+
+            def validate_password(self, username, password):
+                return True
+
+        async def listen():
+            host_key = asyncssh.generate_private_key("ssh-ed25519")
+            return await asyncssh.listen(
+                "127.0.0.1",
+                0,
+                server_factory=PasswordServer,
+                server_host_keys=[host_key],
+                sftp_factory=lambda chan: asyncssh.SFTPServer(chan, chroot=self.root),
+            )
+
+        self.acceptor = self.run(listen())
+        self.port = self.acceptor.sockets[0].getsockname()[1]
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def drop_connections(self):
+        """Abort every client connection, as a network failure would do"""
+
+        async def abort_all():
+            while self.connections:
+                self.connections.pop().abort()
+
+        self.run(abort_all())
+        return
+
+    def close(self):
+        async def close_all():
+            self.acceptor.close()
+            await self.acceptor.wait_closed()
+            while self.connections:
+                conn = self.connections.pop()
+                conn.close()
+                await conn.wait_closed()
+
+        self.run(close_all())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        return
+
+
+@pytest.fixture
+def sftp_server(tmp_path):
+    """Local sftp server serving an empty temporary folder"""
+    asyncssh = pytest.importorskip("asyncssh")
+    root = tmp_path / "sftp_root"
+    root.mkdir()
+    server = LocalSftpServer(asyncssh, root)
+    yield server
+    server.close()
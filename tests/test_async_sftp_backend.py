@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import os
+import hashlib
+import threading
+import pytest
+from relecov_tools.sftp_client import SftpRelecov
+
+async_sftp_client = pytest.importorskip("relecov_tools.async_sftp_client")
+pytest.importorskip("asyncssh")
+
+
+def connect(backend, sftp_server):
+    client = backend(None, "test_user", "test_password")
+    client.sftp_server = "127.0.0.1"
+    client.sftp_port = sftp_server.port
+    assert client.open_connection()
+    return client
+
+
+@pytest.fixture
+def async_sftp(sftp_server):
+    client = connect(async_sftp_client.AsyncSftpRelecov, sftp_server)
+    yield client
+    client.close_transport()
+
+
+def test_download_matches_paramiko(sftp_server, async_sftp, tmp_path):
+    sftp = connect(SftpRelecov, sftp_server)
+    local_file = tmp_path / "upload.bin"
+    local_file.write_bytes(os.urandom(3 * 1048576 + 123))
+    assert async_sftp.make_dir("lab")
+    assert async_sftp.upload_file(str(local_file), "lab/upload.bin")
+    infos = [
+        client.stream_from_sftp("lab/upload.bin", str(tmp_path / name))
+        for name, client in (("async.bin", async_sftp), ("sync.bin", sftp))
+    ]
+    sftp.client.close()
+    local_md5 = hashlib.md5(local_file.read_bytes()).hexdigest()
+    assert infos[0] and infos[0] == infos[1]
+    assert infos[0]["md5"] == local_md5
+
+
+def test_run_concurrently_from_worker_thread(sftp_server, async_sftp):
+    names = [f"small_{idx}.txt" for idx in range(50)]
+    for name in names:
+        open(os.path.join(sftp_server.root, name), "w").close()
+    results = []
+    # Download workers send requests from their own thread, with more requests
+    # than max_requests waiting for the limit
+    worker = threading.Thread(
+        target=lambda: results.extend(
+            async_sftp.run_concurrently(
+                "rename", [(name, "r_" + name) for name in names], max_requests=4
+            )
+        )
+    )
+    worker.start()
+    worker.join()
+    assert len(results) == len(names)
+    assert not any(isinstance(res, Exception) for res in results)
+    assert sorted(async_sftp.get_file_list(".")) == sorted("./r_" + n for n in names)
+
+
+def test_missing_file_is_not_retried(async_sftp):
+    assert async_sftp.remove_file("missing.txt") is False
+    assert async_sftp.connection_stats["reconnections"] == 0
+
+
+def test_reconnect_after_connection_lost(sftp_server, async_sftp):
+    open(os.path.join(sftp_server.root, "sample.fastq.gz"), "w").close()
+    sftp_server.drop_connections()
+    assert async_sftp.get_file_list(".") == ["./sample.fastq.gz"]
+    assert async_sftp.connection_stats["reconnections"] == 1